@@ -1,8 +1,16 @@
+import array
+import bisect
+import collections
 import ctypes
 import functools
 import io
 import math
+import mmap
+import os
 import queue
+import shutil
+import struct
+import threading
 
 
 def wcs_cmp(str_a, str_b):
@@ -15,6 +23,117 @@ def wcs_cmp(str_a, str_b):
     return -1 if tmp < 0 else 1 if tmp > 0 else 0
 
 
+# ----------------------------- DIRECTORY HASH ------------------------------
+# Port of fs/ext4/hash.c, used for hash tree (dx_dir) lookups
+
+DX_HASH_LEGACY = 0
+DX_HASH_HALF_MD4 = 1
+DX_HASH_TEA = 2
+DX_HASH_LEGACY_UNSIGNED = 3
+DX_HASH_HALF_MD4_UNSIGNED = 4
+DX_HASH_TEA_UNSIGNED = 5
+
+DX_DEFAULT_SEED = (0x67452301, 0xEFCDAB89, 0x98BADCFE, 0x10325476)
+MASK32 = 0xFFFFFFFF
+
+
+def _rol32(value, shift):
+    return ((value << shift) | (value >> (32 - shift))) & MASK32
+
+
+def _tea_transform(buf, data):
+    total = 0
+    b0, b1 = buf[0], buf[1]
+    a, b, c, d = data
+
+    for _ in range(16):
+        total = (total + 0x9E3779B9) & MASK32
+        b0 = (b0 + ((((b1 << 4) + a) & MASK32) ^ ((b1 + total) & MASK32) ^ ((b1 >> 5) + b))) & MASK32
+        b1 = (b1 + ((((b0 << 4) + c) & MASK32) ^ ((b0 + total) & MASK32) ^ ((b0 >> 5) + d))) & MASK32
+
+    buf[0] = (buf[0] + b0) & MASK32
+    buf[1] = (buf[1] + b1) & MASK32
+
+
+def _half_md4_transform(buf, data):
+    f = lambda x, y, z: z ^ (x & (y ^ z))
+    g = lambda x, y, z: ((x & y) + ((x ^ y) & z)) & MASK32
+    h = lambda x, y, z: x ^ y ^ z
+    rounds = (
+        (f, 0, ((0, 3), (1, 7), (2, 11), (3, 19), (4, 3), (5, 7), (6, 11), (7, 19))),
+        (g, 0o13240474631, ((1, 3), (3, 5), (5, 9), (7, 13), (0, 3), (2, 5), (4, 9), (6, 13))),
+        (h, 0o15666365641, ((3, 3), (7, 9), (2, 11), (6, 15), (1, 3), (5, 9), (0, 11), (4, 15))),
+    )
+
+    state = list(buf)
+    for func, key, steps in rounds:
+        for step, (idx, shift) in enumerate(steps):
+            # Registers rotate a, d, c, b like the ROUND() macro arguments
+            a, b, c, d = (-step % 4), (1 - step) % 4, (2 - step) % 4, (3 - step) % 4
+            value = (state[a] + func(state[b], state[c], state[d]) + data[idx] + key) & MASK32
+            state[a] = _rol32(value, shift)
+
+    for i in range(4):
+        buf[i] = (buf[i] + state[i]) & MASK32
+
+
+def _str2hashbuf(msg, num, signed):
+    pad = len(msg) | (len(msg) << 8)
+    pad = (pad | (pad << 16)) & MASK32
+    val = pad
+    result = []
+
+    for i, char in enumerate(msg[:num * 4]):
+        if signed and char > 0x7F:
+            char -= 0x100
+        val = (char + (val << 8)) & MASK32
+        if i % 4 == 3:
+            result.append(val)
+            val = pad
+
+    if len(result) < num:
+        result.append(val)
+    result.extend([pad] * (num - len(result)))
+    return result
+
+
+def _dx_hack_hash(name, signed):
+    hash0, hash1 = 0x12A3FE2D, 0x37ABE8F9
+
+    for char in name:
+        if signed and char > 0x7F:
+            char -= 0x100
+        value = (hash1 + (hash0 ^ ((char * 7152373) & MASK32))) & MASK32
+        if value & 0x80000000:
+            value = (value - 0x7FFFFFFF) & MASK32
+        hash1, hash0 = hash0, value
+
+    return (hash0 << 1) & MASK32
+
+
+def dx_hash(name, hash_version, seed=None):
+    buf = list(seed) if seed and any(seed) else list(DX_DEFAULT_SEED)
+    signed = hash_version in (DX_HASH_LEGACY, DX_HASH_HALF_MD4, DX_HASH_TEA)
+
+    if hash_version in (DX_HASH_LEGACY, DX_HASH_LEGACY_UNSIGNED):
+        result = _dx_hack_hash(name, signed)
+    elif hash_version in (DX_HASH_HALF_MD4, DX_HASH_HALF_MD4_UNSIGNED):
+        for i in range(0, len(name), 32):
+            _half_md4_transform(buf, _str2hashbuf(name[i:], 8, signed))
+        result = buf[1]
+    elif hash_version in (DX_HASH_TEA, DX_HASH_TEA_UNSIGNED):
+        for i in range(0, len(name), 16):
+            _tea_transform(buf, _str2hashbuf(name[i:], 4, signed))
+        result = buf[0]
+    else:
+        raise Ext4Error(f"Unsupported directory hash version {hash_version:d}")
+
+    result &= ~1
+    if result == 0x7FFFFFFF << 1:
+        result = (0x7FFFFFFF - 1) << 1
+    return result
+
+
 class Ext4Error(Exception):
     ...
 
@@ -71,11 +190,13 @@ class ext4_dir_entry_2(ext4_struct):
     @staticmethod
     def _from_buffer_copy(raw, offset=0, platform64=True):
         struct = ext4_dir_entry_2.from_buffer_copy(raw, offset)
-        struct.name = raw[offset + 0x8: offset + 0x8 + struct.name_len]
+        struct.name = bytes(raw[offset + 0x8: offset + 0x8 + struct.name_len])
         return struct
 
 
 class ext4_extent(ext4_struct):
+    EXT_INIT_MAX_LEN = 0x8000  # ee_len above this marks an unwritten (preallocated, reads as zeros) extent
+
     _fields_ = [
         ("ee_block", ctypes.c_uint),  # 0x0000
         ("ee_len", ctypes.c_ushort),  # 0x0004
@@ -104,6 +225,9 @@ class ext4_extent_idx(ext4_struct):
 
 
 class ext4_group_descriptor(ext4_struct):
+    # bg_flags
+    EXT4_BG_INODE_UNINIT = 0x1  # Inode table and bitmap are not initialized
+
     _fields_ = [
         ("bg_block_bitmap_lo", ctypes.c_uint),  # 0x0000
         ("bg_inode_bitmap_lo", ctypes.c_uint),  # 0x0004
@@ -227,6 +351,9 @@ class ext4_superblock(ext4_struct):
     INCOMPAT_32BIT = 0x66
 
     INCOMPAT_FILETYPE = 0x2  # Directory entries record file type (instead of inode flags)
+    INCOMPAT_CASEFOLD = 0x20000  # Case-insensitive directories, names are hashed after folding
+    # s_flags
+    EXT2_FLAGS_UNSIGNED_HASH = 0x2  # Directory hashes treat names as unsigned chars
     _fields_ = [
         ("s_inodes_count", ctypes.c_uint),  # 0x0000
         ("s_blocks_count_lo", ctypes.c_uint),  # 0x0004
@@ -394,7 +521,7 @@ class ext4_xattr_entry(ext4_struct):
     @staticmethod
     def _from_buffer_copy(raw, offset=0, platform64=True):
         struct = ext4_xattr_entry.from_buffer_copy(raw, offset)
-        struct.e_name = raw[offset + 0x10: offset + 0x10 + struct.e_name_len]
+        struct.e_name = bytes(raw[offset + 0x10: offset + 0x10 + struct.e_name_len])
         return struct
 
     @property
@@ -418,6 +545,78 @@ class ext4_xattr_ibody_header(ext4_struct):
     ]
 
 
+# ----------------------------- FAST DECODERS ------------------------------
+# Precompiled struct decoders for the hot path, *_lo and *_hi pairs are combined once at decode time
+
+InodeRecord = collections.namedtuple("InodeRecord", "i_mode i_uid i_gid i_size i_flags i_links_count i_file_acl")
+DirEntry = collections.namedtuple("DirEntry", "inode rec_len name_len file_type name")
+ExtentHeader = collections.namedtuple("ExtentHeader", "eh_magic eh_entries eh_max eh_depth eh_generation")
+Extent = collections.namedtuple("Extent", "ee_block ee_len ee_start")
+ExtentIdx = collections.namedtuple("ExtentIdx", "ei_block ei_leaf")
+XattrEntry = collections.namedtuple("XattrEntry",
+                                    "e_name_len e_name_index e_value_offs e_value_inum e_value_size e_hash e_name")
+
+# i_mode, i_uid_lo, i_size_lo, i_gid_lo, i_links_count, i_flags, i_file_acl_lo, i_size_hi, i_file_acl_hi, i_uid_hi,
+# i_gid_hi of the first EXT2_GOOD_OLD_INODE_SIZE bytes
+inode_decoder = struct.Struct("<HHI16xHH4xI4x60x4xII4x2xHHH4x")
+dir_entry_decoder = struct.Struct("<IHBB")
+extent_header_decoder = struct.Struct("<HHHHI")
+extent_decoder = struct.Struct("<IHHI")
+extent_idx_decoder = struct.Struct("<IIH2x")
+xattr_entry_decoder = struct.Struct("<BBHIII")
+xattr_magic_decoder = struct.Struct("<I")
+xattr_header_decoder = struct.Struct("<I4xI")  # h_magic, h_blocks
+extra_isize_decoder = struct.Struct("<H")
+dx_root_info_decoder = struct.Struct("<4xBBBB")  # hash_version, info_length, indirect_levels, unused_flags
+dx_countlimit_decoder = struct.Struct("<HH")  # limit, count
+dx_entry_decoder = struct.Struct("<II")  # hash, block
+
+
+def decode_inode(raw, offset=0):
+    mode, uid_lo, size_lo, gid_lo, links_count, flags, file_acl_lo, size_hi, file_acl_hi, uid_hi, gid_hi = \
+        inode_decoder.unpack_from(raw, offset)
+    return InodeRecord(mode, uid_lo | (uid_hi << 16), gid_lo | (gid_hi << 16), size_lo | (size_hi << 32), flags,
+                       links_count, file_acl_lo | (file_acl_hi << 32))
+
+
+def decode_dir_entry(raw, offset=0):
+    inode, rec_len, name_len, file_type = dir_entry_decoder.unpack_from(raw, offset)
+    return DirEntry(inode, rec_len, name_len, file_type, bytes(raw[offset + 0x8: offset + 0x8 + name_len]))
+
+
+def decode_extent_header(raw, offset=0):
+    return ExtentHeader._make(extent_header_decoder.unpack_from(raw, offset))
+
+
+def decode_extents(raw):
+    return [Extent(ee_block, ee_len, ee_start_lo | (ee_start_hi << 32))
+            for ee_block, ee_len, ee_start_hi, ee_start_lo in extent_decoder.iter_unpack(raw)]
+
+
+def decode_extent_indices(raw):
+    return [ExtentIdx(ei_block, ei_leaf_lo | (ei_leaf_hi << 32))
+            for ei_block, ei_leaf_lo, ei_leaf_hi in extent_idx_decoder.iter_unpack(raw)]
+
+
+def decode_xattr_entry(raw, offset=0):
+    name_len, name_index, value_offs, value_inum, value_size, hash_ = xattr_entry_decoder.unpack_from(raw, offset)
+    return XattrEntry(name_len, name_index, value_offs, value_inum, value_size, hash_,
+                      bytes(raw[offset + 0x10: offset + 0x10 + name_len]))
+
+
+# e_name_index -> name prefix
+XATTR_PREFIXES = {
+    0: "",
+    1: "user.",
+    2: "system.posix_acl_access",
+    3: "system.posix_acl_default",
+    4: "trusted.",
+    6: "security.",
+    7: "system.",
+    8: "system.richacl"
+}
+
+
 class InodeType:
     UNKNOWN = 0x0  # Unknown file type
     FILE = 0x1  # Regular file
@@ -475,16 +674,108 @@ class MappingEntry:
             idx += 1
 
 
+# Permission and special bits -> 4 digit octal string as used by fs_config, 0o4755 -> "4755"
+PERM_STRINGS = tuple(f"{perm:04o}" for perm in range(0o10000))
+
+
+class InodeTable:
+    """
+    Common inode fields of the whole volume decoded in bulk, one read per group inode table.
+
+    Each attribute is an array indexed by inode number (index 0 is unused).
+    """
+
+    def __init__(self, volume):
+        inode_size = volume.superblock.s_inode_size
+        inodes_per_group = volume.superblock.s_inodes_per_group
+        decoder = struct.Struct(f"{inode_decoder.format}{inode_size - ext4_inode.EXT2_GOOD_OLD_INODE_SIZE:d}x")
+
+        self.mode = array.array("H", [0])
+        self.uid = array.array("I", [0])
+        self.gid = array.array("I", [0])
+        self.size = array.array("Q", [0])
+        self.flags = array.array("I", [0])
+        self.links_count = array.array("H", [0])
+        self.file_acl = array.array("Q", [0])
+
+        for group_descriptor in volume.group_descriptors:
+            if group_descriptor.bg_flags & ext4_group_descriptor.EXT4_BG_INODE_UNINIT:
+                columns = [[0] * inodes_per_group] * 11
+            else:
+                raw = volume.read(group_descriptor.bg_inode_table * volume.block_size, inodes_per_group * inode_size)
+                if len(raw) != inodes_per_group * inode_size:
+                    # Truncated image, the missing part reads as zeros
+                    raw = bytes(raw) + bytes(inodes_per_group * inode_size - len(raw))
+                columns = list(zip(*decoder.iter_unpack(raw)))
+            mode, uid_lo, size_lo, gid_lo, links_count, flags, file_acl_lo, size_hi, file_acl_hi, uid_hi, gid_hi = columns
+
+            self.mode.extend(mode)
+            self.uid.extend(lo | (hi << 16) for lo, hi in zip(uid_lo, uid_hi))
+            self.gid.extend(lo | (hi << 16) for lo, hi in zip(gid_lo, gid_hi))
+            self.size.extend(lo | (hi << 32) for lo, hi in zip(size_lo, size_hi))
+            self.flags.extend(flags)
+            self.links_count.extend(links_count)
+            self.file_acl.extend(lo | (hi << 32) for lo, hi in zip(file_acl_lo, file_acl_hi))
+
+    def __len__(self):
+        return len(self.mode)
+
+    def permission_strings(self):
+        # PERM_STRINGS of every inode, indexed by inode number
+        return [PERM_STRINGS[mode & 0o7777] for mode in self.mode]
+
+
 class Volume:
+    """
+    An ext4 file system image.
+
+    Reads are positional (mmap slices, os.pread or the stream's own read_at) and never depend on a shared file
+    cursor, so one Volume and the Inode and BlockReader objects created from it can be used from many threads at
+    once. Other streams fall back to seek + read under a lock.
+    """
     ROOT_INODE = 2
 
-    def __init__(self, stream, offset=0, ignore_flags=False, ignore_magic=False):
+    XATTR_CACHE_SIZE = 256  # Parsed xattr blocks kept per volume
+
+    def __init__(self, stream, offset=0, ignore_flags=False, ignore_magic=False, use_mmap=False, bulk_inodes=False,
+                 xattr_cache_size=XATTR_CACHE_SIZE, index=None, block_cache_size=0):
         self.ignore_flags = ignore_flags
         self.ignore_magic = ignore_magic
         self.offset = offset
         self.platform64 = True  # Initial value needed for Volume.read_struct
         self.stream = stream
 
+        # Zero-copy backend: read() returns memoryview slices of the mapped image
+        self.mmap = None
+        self.view = None
+        if use_mmap:
+            try:
+                # ACCESS_COPY keeps the mapping writable (required by ctypes from_buffer) without touching the file
+                self.mmap = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_COPY)
+                self.view = memoryview(self.mmap)
+            except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+                # Not a real file, empty or too large to map (32-bit), fall back to stream reads
+                self.mmap = None
+
+        # Positional reads without a shared cursor
+        self.fd = None
+        if self.mmap is None and hasattr(os, "pread"):
+            try:
+                self.fd = stream.fileno()
+            except (AttributeError, OSError, io.UnsupportedOperation):
+                self.fd = None
+        # Virtual images (e.g. sparse_img.SparseImageFile) provide their own positional read_at()
+        self.stream_read_at = getattr(stream, "read_at", None) if self.mmap is None and self.fd is None else None
+        self.lock = threading.Lock()
+
+        # Block cache for metadata reads (inode tables, extent tree, directory, xattr and bitmap blocks), file data
+        # is read with metadata=False and never enters it. Off by default, an mmap'ed image gains little from it.
+        self.block_cache = None
+        self.block_cache_size = block_cache_size
+        self.block_cache_lock = threading.Lock()
+        self.block_cache_hits = 0
+        self.block_cache_misses = 0
+
         # Superblock
         self.superblock = self.read_struct(ext4_superblock, 0x400)
         self.platform64 = (self.superblock.s_feature_incompat & ext4_superblock.INCOMPAT_64BIT) != 0
@@ -496,13 +787,48 @@ class Volume:
         self.group_descriptors = [None] * (self.superblock.s_inodes_count // self.superblock.s_inodes_per_group)
 
         group_desc_table_offset = (0x400 // self.block_size + 1) * self.block_size  # First block after superblock
+        group_desc_size = ctypes.sizeof(ext4_group_descriptor)
+        group_desc_table = self.read(group_desc_table_offset, max(
+            0, (len(self.group_descriptors) - 1) * self.superblock.s_desc_size + group_desc_size))
         for group_desc_idx in range(len(self.group_descriptors)):
-            group_desc_offset = group_desc_table_offset + group_desc_idx * self.superblock.s_desc_size
-            self.group_descriptors[group_desc_idx] = self.read_struct(ext4_group_descriptor, group_desc_offset)
+            group_desc_offset = group_desc_idx * self.superblock.s_desc_size
+            self.group_descriptors[group_desc_idx] = ext4_group_descriptor._from_buffer_copy(
+                group_desc_table[group_desc_offset:group_desc_offset + group_desc_size], platform64=self.platform64)
+
+        # Columnar inode index, Inode objects read their common fields from it
+        self.inode_table = InodeTable(self) if bulk_inodes else None
+
+        # Prebuilt ext4index.Ext4Index, answers directory listings, lookups, extents and xattrs without parsing
+        self.index = index
+
+        if block_cache_size > 0:
+            self.block_cache = collections.OrderedDict()
+
+        # Parsed xattr blocks (block number -> ((name, value), ...)) in LRU order, most inodes of an Android image
+        # share the same few blocks
+        self.xattr_cache = collections.OrderedDict()
+        self.xattr_cache_size = xattr_cache_size
+        self.xattr_cache_lock = threading.Lock()
 
     def __repr__(self):
         return f"{type(self).__name__:s}(volume_name = {self.superblock.s_volume_name!r:s}, uuid = {self.uuid!r:s}, last_mounted = {self.superblock.s_last_mounted!r:s})"
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        # Unmaps the image, Windows keeps a mapped file locked. The stream belongs to the caller, views returned by
+        # read() must not be used afterwards
+        if self.view is not None:
+            self.view.release()
+            self.view = None
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+
     @property
     def block_size(self):
         return 1 << (10 + self.superblock.s_log_block_size)
@@ -521,18 +847,71 @@ class Volume:
 
         return Inode(self, inode_offset, inode_idx, file_type)
 
+    def get_inode_by_path(self, path):
+        # "system/build.prop" or "/system/build.prop", one dict lookup when the volume has an index
+        parts = [part for part in path.split("/") if part]
+        if self.index is not None and "/".join(parts) in self.index.paths:
+            return self.get_inode(*self.index.paths["/".join(parts)])
+        return self.root.get_inode(*parts)
+
     def get_inode_group(self, inode_idx):
         group_idx = (inode_idx - 1) // self.superblock.s_inodes_per_group
         inode_table_entry_idx = (inode_idx - 1) % self.superblock.s_inodes_per_group
         return group_idx, inode_table_entry_idx
 
-    def read(self, offset, byte_len):
-        if self.offset + offset != self.stream.tell():
-            self.stream.seek(self.offset + offset, io.SEEK_SET)
-
-        return self.stream.read(byte_len)
+    def read(self, offset, byte_len, metadata=True):
+        # Reads larger than half the cache would only evict it
+        if self.block_cache is not None and metadata and 0 < byte_len <= self.block_cache_size * self.block_size // 2:
+            return self._read_cached(offset, byte_len)
+        return self._read(offset, byte_len)
+
+    def _read_cached(self, offset, byte_len):
+        block_size = self.block_size
+        first_block = offset // block_size
+        blocks = [self._cached_block(block_idx)
+                  for block_idx in range(first_block, (offset + byte_len - 1) // block_size + 1)]
+        start = offset - first_block * block_size
+        return (blocks[0] if len(blocks) == 1 else b"".join(blocks))[start:start + byte_len]
+
+    def _cached_block(self, block_idx):
+        cache = self.block_cache
+        with self.block_cache_lock:
+            block = cache.get(block_idx)
+            if block is not None:
+                cache.move_to_end(block_idx)
+                self.block_cache_hits += 1
+                return block
+            self.block_cache_misses += 1
+
+        block = bytes(self._read(block_idx * self.block_size, self.block_size))
+        with self.block_cache_lock:
+            cache[block_idx] = block
+            while len(cache) > self.block_cache_size:
+                cache.popitem(last=False)
+        return block
+
+    def _read(self, offset, byte_len):
+        if self.view is not None:
+            start = self.offset + offset
+            return self.view[start:start + byte_len]
+
+        if self.fd is not None:
+            return os.pread(self.fd, byte_len, self.offset + offset)
+
+        if self.stream_read_at is not None:
+            return self.stream_read_at(self.offset + offset, byte_len)
+
+        with self.lock:
+            if self.offset + offset != self.stream.tell():
+                self.stream.seek(self.offset + offset, io.SEEK_SET)
+
+            return self.stream.read(byte_len)
 
     def read_struct(self, structure, offset, platform64=None):
+        if self.mmap is not None and not hasattr(structure, "_from_buffer_copy"):
+            # Decode in place, _from_buffer_copy variants patch fields and must work on a private copy
+            return structure.from_buffer(self.mmap, self.offset + offset)
+
         raw = self.read(offset, ctypes.sizeof(structure))
 
         if hasattr(structure, "_from_buffer_copy"):
@@ -544,6 +923,12 @@ class Volume:
     def root(self):
         return self.get_inode(Volume.ROOT_INODE, InodeType.DIRECTORY)
 
+    @functools.cached_property
+    def hash_unsigned(self):
+        # s_flags is read raw, _from_buffer_copy clears it on non 64-bit volumes
+        s_flags, = struct.unpack("<I", self.read(0x400 + ext4_superblock.s_flags.offset, 4))
+        return (s_flags & ext4_superblock.EXT2_FLAGS_UNSIGNED_HASH) != 0
+
     @property
     def uuid(self):
         uuid = self.superblock.s_uuid
@@ -558,10 +943,41 @@ class Inode:
         self.volume = volume
 
         self.file_type = file_type
-        self.inode = volume.read_struct(ext4_inode, offset)
+
+        record = volume.index.inodes.get(inode_idx) if volume.index is not None else None
+        table = volume.inode_table
+        if record is None and table is not None and 0 < inode_idx < len(table):
+            self.mode = table.mode[inode_idx]
+            self.uid = table.uid[inode_idx]
+            self.gid = table.gid[inode_idx]
+            self.size = table.size[inode_idx]
+            self.flags = table.flags[inode_idx]
+            self.links_count = table.links_count[inode_idx]
+            self.file_acl = table.file_acl[inode_idx]
+        else:
+            if record is None:
+                record = decode_inode(volume.read(offset, ext4_inode.EXT2_GOOD_OLD_INODE_SIZE))
+            self.mode = record.i_mode
+            self.uid = record.i_uid
+            self.gid = record.i_gid
+            self.size = record.i_size
+            self.flags = record.i_flags
+            self.links_count = record.i_links_count
+            self.file_acl = record.i_file_acl
 
     def __len__(self):
-        return self.inode.i_size
+        return self.size
+
+    @functools.cached_property
+    def inode(self):
+        return self.volume.read_struct(ext4_inode, self.offset)
+
+    @property
+    def extra_isize(self):
+        if self.volume.superblock.s_inode_size <= ext4_inode.EXT2_GOOD_OLD_INODE_SIZE:
+            return 0
+        return extra_isize_decoder.unpack(
+            self.volume.read(self.offset + ext4_inode.EXT2_GOOD_OLD_INODE_SIZE, extra_isize_decoder.size))[0]
 
     def __repr__(self):
         if self.inode_idx is not None:
@@ -569,23 +985,12 @@ class Inode:
         else:
             return f"{type(self).__name__:s}(offset = 0x{self.offset:X}, volume_uuid = {self.volume.uuid!r:s})"
 
-    def _parse_xattrs(self, raw_data, offset):
-        prefixes = {
-            0: "",
-            1: "user.",
-            2: "system.posix_acl_access",
-            3: "system.posix_acl_default",
-            4: "trusted.",
-            6: "security.",
-            7: "system.",
-            8: "system.richacl"
-        }
-        prefixes.update(prefixes)
-
-        # Iterator over ext4_xattr_entry structures
+    def _parse_xattrs(self, raw_data, offset, names=None):
+        # Iterator over ext4_xattr_entry structures, values of names not in names are skipped without being read
+        prefixes = XATTR_PREFIXES
         i = 0
         while i < len(raw_data):
-            xattr_entry = ext4_xattr_entry._from_buffer_copy(raw_data, i, platform64=self.volume.platform64)
+            xattr_entry = decode_xattr_entry(raw_data, i)
 
             if not (
                     xattr_entry.e_name_len | xattr_entry.e_name_index | xattr_entry.e_value_offs | xattr_entry.e_value_inum):
@@ -597,24 +1002,25 @@ class Inode:
 
             xattr_name = prefixes[xattr_entry.e_name_index] + xattr_entry.e_name.decode("iso-8859-2")
 
-            if xattr_entry.e_value_inum != 0:
-                # external xattr
-                xattr_inode = self.volume.get_inode(xattr_entry.e_value_inum, InodeType.FILE)
+            if names is None or xattr_name in names:
+                if xattr_entry.e_value_inum != 0:
+                    # external xattr
+                    xattr_inode = self.volume.get_inode(xattr_entry.e_value_inum, InodeType.FILE)
 
-                if not self.volume.ignore_flags and (xattr_inode.inode.i_flags & ext4_inode.EXT4_EA_INODE_FL) != 0:
-                    raise Ext4Error(
-                        f"Inode {xattr_inode.inode_idx:d} associated with the extended attribute {xattr_name!r:s} of inode {self.inode_idx:d} is not marked as large extended attribute value.")
+                    if not self.volume.ignore_flags and (xattr_inode.flags & ext4_inode.EXT4_EA_INODE_FL) != 0:
+                        raise Ext4Error(
+                            f"Inode {xattr_inode.inode_idx:d} associated with the extended attribute {xattr_name!r:s} of inode {self.inode_idx:d} is not marked as large extended attribute value.")
 
-                # TODO Use xattr_entry.e_value_size or xattr_inode.inode.i_size?
-                xattr_value = xattr_inode.open_read().read()
-            else:
-                # internal xattr
-                xattr_value = raw_data[
-                              xattr_entry.e_value_offs + offset: xattr_entry.e_value_offs + offset + xattr_entry.e_value_size]
+                    # TODO Use xattr_entry.e_value_size or xattr_inode.inode.i_size?
+                    xattr_value = xattr_inode.open_read().read()
+                else:
+                    # internal xattr
+                    xattr_value = bytes(raw_data[
+                                  xattr_entry.e_value_offs + offset: xattr_entry.e_value_offs + offset + xattr_entry.e_value_size])
 
-            yield xattr_name, xattr_value
+                yield xattr_name, xattr_value
 
-            i += xattr_entry._size
+            i += 4 * ((xattr_entry_decoder.size + xattr_entry.e_name_len + 3) // 4)  # 4-byte alignment
 
     @staticmethod
     def directory_entry_comparator(dir_a, dir_b):
@@ -629,6 +1035,79 @@ class Inode:
 
     directory_entry_key = functools.cmp_to_key(directory_entry_comparator)
 
+    def _dx_entries(self, node, offset):
+        # [(hash, block)] of a dx_root / dx_node, the first entry has an implied hash of 0
+        _, count = dx_countlimit_decoder.unpack_from(node, offset)
+        entries = [(0, dx_entry_decoder.unpack_from(node, offset)[1])]
+        entries.extend(dx_entry_decoder.unpack_from(node, offset + i * dx_entry_decoder.size) for i in range(1, count))
+        return entries
+
+    def _dx_lookup(self, raw_name):
+        # Hash tree lookup, returns (inode, file_type), None if missing, NotImplemented if the tree can't be used
+        reader = self.open_read()
+        block_size = self.volume.block_size
+
+        root = reader.read_at(0, block_size)
+        hash_version, info_length, indirect_levels, _ = dx_root_info_decoder.unpack_from(root, 0x18)
+        if hash_version > DX_HASH_TEA_UNSIGNED or \
+                (self.volume.superblock.s_feature_incompat & ext4_superblock.INCOMPAT_CASEFOLD) != 0:
+            return NotImplemented
+        if hash_version <= DX_HASH_TEA and self.volume.hash_unsigned:
+            hash_version += DX_HASH_LEGACY_UNSIGNED
+        name_hash = dx_hash(raw_name, hash_version, list(self.volume.superblock.s_hash_seed))
+
+        # Descend to the leaf, keeping the path for hash collisions spanning several leaves
+        path = []
+        entries = self._dx_entries(root, 0x18 + info_length)
+        while True:
+            position = bisect.bisect_right([entry_hash for entry_hash, _ in entries], name_hash) - 1
+            path.append([entries, max(position, 0)])
+            if len(path) > indirect_levels:
+                break
+            entries = self._dx_entries(reader.read_at(entries[path[-1][1]][1] * block_size, block_size), 0x8)
+
+        while True:
+            entries, position = path[-1]
+            leaf = reader.read_at(entries[position][1] * block_size, block_size)
+            offset = 0
+            while offset < len(leaf):
+                dirent = decode_dir_entry(leaf, offset)
+                if dirent.rec_len < 8:
+                    break
+                if dirent.inode != 0 and dirent.file_type != InodeType.CHECKSUM and dirent.name == raw_name:
+                    return dirent.inode, dirent.file_type
+                offset += dirent.rec_len
+
+            # Continue in the next leaf only if it holds the same hash (collision bit set)
+            level = len(path) - 1
+            while level >= 0 and path[level][1] + 1 >= len(path[level][0]):
+                level -= 1
+            if level < 0:
+                return None
+            path[level][1] += 1
+            entries, position = path[level]
+            if (entries[position][0] & ~1) != name_hash:
+                return None
+            for lower in range(level + 1, len(path)):
+                upper_entries, upper_position = path[lower - 1]
+                path[lower] = [self._dx_entries(reader.read_at(upper_entries[upper_position][1] * block_size,
+                                                               block_size), 0x8), 0]
+
+    def lookup(self, name, decode_name=None):
+        # Returns (file_name, inode_idx, file_type) of the entry, (None, None, None) if it does not exist
+        index = self.volume.index
+        if decode_name is None and index is not None and self.inode_idx in index.children:
+            entry = index.names.get((self.inode_idx, name.encode("utf8")))
+            return (name, *entry) if entry else (None, None, None)
+
+        # "." and ".." live in the dx_root block, not in the hashed leaves
+        if decode_name is None and (self.flags & ext4_inode.EXT4_INDEX_FL) != 0 and name not in (".", ".."):
+            found = self._dx_lookup(name.encode("utf8"))
+            if found is not NotImplemented:
+                return (name, *found) if found else (None, None, None)
+
+        return next(filter(lambda entry: entry[0] == name, self.open_dir(decode_name)), (None, None, None))
+
     def get_inode(self, *relative_path, decode_name=None):
         if not self.is_dir:
             raise Ext4Error(f"Inode {self.inode_idx:d} is not a directory.")
@@ -641,8 +1120,7 @@ class Inode:
                 raise Ext4Error(f"{current_path!r:s} (Inode {inode_idx:d}) is not a directory."
                                 )
 
-            file_name, inode_idx, file_type = next(
-                filter(lambda entry: entry[0] == part, current_inode.open_dir(decode_name)), (None, None, None))
+            file_name, inode_idx, file_type = current_inode.lookup(part, decode_name)
 
             if inode_idx is None:
                 current_path = "/".join(relative_path[:i])
@@ -656,21 +1134,21 @@ class Inode:
     @property
     def is_dir(self):
         if (self.volume.superblock.s_feature_incompat & ext4_superblock.INCOMPAT_FILETYPE) == 0:
-            return (self.inode.i_mode & ext4_inode.S_IFDIR) != 0
+            return (self.mode & ext4_inode.S_IFDIR) != 0
         else:
             return self.file_type == InodeType.DIRECTORY
 
     @property
     def is_file(self):
         if (self.volume.superblock.s_feature_incompat & ext4_superblock.INCOMPAT_FILETYPE) == 0:
-            return (self.inode.i_mode & ext4_inode.S_IFREG) != 0
+            return (self.mode & ext4_inode.S_IFREG) != 0
         else:
             return self.file_type == InodeType.FILE
 
     @property
     def is_symlink(self):
         if (self.volume.superblock.s_feature_incompat & ext4_superblock.INCOMPAT_FILETYPE) == 0:
-            return (self.inode.i_mode & ext4_inode.S_IFLNK) != 0
+            return (self.mode & ext4_inode.S_IFLNK) != 0
         else:
             return self.file_type == InodeType.SYMBOLIC_LINK
 
@@ -683,6 +1161,15 @@ class Inode:
 
         return ((inode_usage_byte >> (7 - bitmap_bit % 8)) & 1) != 0
 
+    @property
+    def permissions(self):
+        # Permission and special (setuid, setgid, sticky) bits, 0o4755 for -rwsr-xr-x
+        return self.mode & 0o7777
+
+    @property
+    def perm_str(self):
+        return PERM_STRINGS[self.mode & 0o7777]
+
     @property
     def mode_str(self):
         special_flag = lambda letter, execute, special: {
@@ -702,7 +1189,7 @@ class Inode:
                     ext4_inode.S_IFREG: "-",
                     ext4_inode.S_IFLNK: "l",
                     ext4_inode.S_IFSOCK: "s",
-                }[self.inode.i_mode & 0xF000]
+                }[self.mode & 0xF000]
             else:
                 device_type = {
                     InodeType.FILE: "-",
@@ -719,20 +1206,20 @@ class Inode:
         return "".join([
             device_type,
 
-            "r" if (self.inode.i_mode & ext4_inode.S_IRUSR) != 0 else "-",
-            "w" if (self.inode.i_mode & ext4_inode.S_IWUSR) != 0 else "-",
-            special_flag("s", (self.inode.i_mode & ext4_inode.S_IXUSR) != 0,
-                         (self.inode.i_mode & ext4_inode.S_ISUID) != 0),
+            "r" if (self.mode & ext4_inode.S_IRUSR) != 0 else "-",
+            "w" if (self.mode & ext4_inode.S_IWUSR) != 0 else "-",
+            special_flag("s", (self.mode & ext4_inode.S_IXUSR) != 0,
+                         (self.mode & ext4_inode.S_ISUID) != 0),
 
-            "r" if (self.inode.i_mode & ext4_inode.S_IRGRP) != 0 else "-",
-            "w" if (self.inode.i_mode & ext4_inode.S_IWGRP) != 0 else "-",
-            special_flag("s", (self.inode.i_mode & ext4_inode.S_IXGRP) != 0,
-                         (self.inode.i_mode & ext4_inode.S_ISGID) != 0),
+            "r" if (self.mode & ext4_inode.S_IRGRP) != 0 else "-",
+            "w" if (self.mode & ext4_inode.S_IWGRP) != 0 else "-",
+            special_flag("s", (self.mode & ext4_inode.S_IXGRP) != 0,
+                         (self.mode & ext4_inode.S_ISGID) != 0),
 
-            "r" if (self.inode.i_mode & ext4_inode.S_IROTH) != 0 else "-",
-            "w" if (self.inode.i_mode & ext4_inode.S_IWOTH) != 0 else "-",
-            special_flag("t", (self.inode.i_mode & ext4_inode.S_IXOTH) != 0,
-                         (self.inode.i_mode & ext4_inode.S_ISVTX) != 0),
+            "r" if (self.mode & ext4_inode.S_IROTH) != 0 else "-",
+            "w" if (self.mode & ext4_inode.S_IWOTH) != 0 else "-",
+            special_flag("t", (self.mode & ext4_inode.S_IXOTH) != 0,
+                         (self.mode & ext4_inode.S_ISVTX) != 0),
         ])
 
     def open_dir(self, decode_name=None):
@@ -744,15 +1231,20 @@ class Inode:
             raise Ext4Error(f"Inode ({self.inode_idx:d}) is not a directory.")
 
         # # Hash trees are compatible with linear arrays
-        if (self.inode.i_flags & ext4_inode.EXT4_INDEX_FL) != 0:
+        if (self.flags & ext4_inode.EXT4_INDEX_FL) != 0:
             ...
 
+        if self.volume.index is not None and self.inode_idx in self.volume.index.children:
+            for raw_name, inode_idx, file_type in self.volume.index.children[self.inode_idx]:
+                yield decode_name(raw_name), inode_idx, file_type
+            return
+
         # Read raw directory content
         raw_data = self.open_read().read()
         offset = 0
 
         while offset < len(raw_data):
-            dirent = ext4_dir_entry_2._from_buffer_copy(raw_data, offset, platform64=self.volume.platform64)
+            dirent = decode_dir_entry(raw_data, offset)
 
             if dirent.file_type != InodeType.CHECKSUM:
                 yield decode_name(dirent.name), dirent.inode, dirent.file_type
@@ -760,106 +1252,199 @@ class Inode:
             offset += dirent.rec_len
 
     def open_read(self):
-        if (self.inode.i_flags & ext4_inode.EXT4_EXTENTS_FL) != 0:
-            # Obtain mapping from extents
-            mapping = []  # List of MappingEntry instances
-
-            nodes = queue.Queue()
-            nodes.put_nowait(self.offset + ext4_inode.i_block.offset)
-
-            while nodes.qsize() != 0:
-                header_offset = nodes.get_nowait()
-                header = self.volume.read_struct(ext4_extent_header, header_offset)
-
-                if not self.volume.ignore_magic and header.eh_magic != 0xF30A:
-                    raise MagicError(
-                        f"Invalid magic value in extent header at offset 0x{self.inode_idx:X} of"
-                        f" inode {self.inode_idx:d}: 0x{header.eh_magic:04X} (expected 0xF30A)")
-
-                if header.eh_depth != 0:
-                    indices = self.volume.read_struct(ext4_extent_idx * header.eh_entries,
-                                                      header_offset + ctypes.sizeof(ext4_extent_header))
-                    for idx in indices:
-                        nodes.put_nowait(idx.ei_leaf * self.volume.block_size)
-                else:
-                    extents = self.volume.read_struct(ext4_extent * header.eh_entries,
-                                                      header_offset + ctypes.sizeof(ext4_extent_header))
-                    for extent in extents:
-                        mapping.append(MappingEntry(extent.ee_block, extent.ee_start, extent.ee_len))
-
-            MappingEntry.optimize(mapping)
-            return BlockReader(self.volume, len(self), mapping)
+        if (self.flags & ext4_inode.EXT4_EXTENTS_FL) != 0:
+            return BlockReader(self.volume, len(self), self.extent_mapping(), self.is_dir)
         else:
             # Inode uses inline data
             i_block = self.volume.read(self.offset + ext4_inode.i_block.offset, ext4_inode.i_block.size)
-            return io.BytesIO(i_block[:self.inode.i_size])
+            return io.BytesIO(i_block[:self.size])
+
+    @property
+    def link_target(self):
+        # Fast symlinks keep the target in i_block, slow ones in a data block
+        index = self.volume.index
+        if index is not None and self.inode_idx in index.link_targets:
+            return index.link_targets[self.inode_idx]
+        try:
+            return self.open_read().read().decode("utf8")
+        except Exception and BaseException:
+            link_target_block = int.from_bytes(self.open_read().read(), "little")
+            return bytes(self.volume.read(link_target_block * self.volume.block_size, self.size)).decode("utf8")
+
+    def extent_mapping(self):
+        # List of MappingEntry instances
+        index = self.volume.index
+        if index is not None and self.inode_idx in index.extents:
+            return [MappingEntry(*extent) for extent in index.extents[self.inode_idx]]
+
+        # Obtain mapping from extents
+        mapping = []
+
+        nodes = queue.Queue()
+        nodes.put_nowait(self.offset + ext4_inode.i_block.offset)
+
+        while nodes.qsize() != 0:
+            header_offset = nodes.get_nowait()
+            header = decode_extent_header(self.volume.read(header_offset, extent_header_decoder.size))
+
+            if not self.volume.ignore_magic and header.eh_magic != 0xF30A:
+                raise MagicError(
+                    f"Invalid magic value in extent header at offset 0x{self.inode_idx:X} of"
+                    f" inode {self.inode_idx:d}: 0x{header.eh_magic:04X} (expected 0xF30A)")
+
+            if header.eh_depth != 0:
+                indices = decode_extent_indices(self.volume.read(header_offset + extent_header_decoder.size,
+                                                                 header.eh_entries * extent_idx_decoder.size))
+                for idx in indices:
+                    nodes.put_nowait(idx.ei_leaf * self.volume.block_size)
+            else:
+                extents = decode_extents(self.volume.read(header_offset + extent_header_decoder.size,
+                                                          header.eh_entries * extent_decoder.size))
+                for extent in extents:
+                    if extent.ee_len > ext4_extent.EXT_INIT_MAX_LEN:
+                        # Unwritten extents are left unmapped and read as zeros
+                        continue
+                    mapping.append(MappingEntry(extent.ee_block, extent.ee_start, extent.ee_len))
+
+        MappingEntry.optimize(mapping)
+        return mapping
+
+    def copy_to(self, fileobj, chunk_size=None):
+        # Streams the content into fileobj, unmapped ranges become holes (seek) instead of written zeros
+        chunk_size = chunk_size or BlockReader.CHUNK_SIZE
+        reader = self.open_read()
+
+        if not isinstance(reader, BlockReader):
+            shutil.copyfileobj(reader, fileobj, chunk_size)
+            return len(self)
+
+        hole = False
+        for disk_offset, run_len in reader.get_runs(0, reader.byte_size):
+            hole = disk_offset is None
+            if hole:
+                fileobj.seek(run_len, io.SEEK_CUR)
+                continue
+
+            for chunk_offset in range(disk_offset, disk_offset + run_len, chunk_size):
+                length = min(chunk_size, disk_offset + run_len - chunk_offset)
+                data = self.volume.read(chunk_offset, length, metadata=False)
+                if len(data) != length:
+                    raise EndOfStreamError(
+                        "The volume's underlying stream ended {0:d} bytes before EOF.".format(length - len(data)))
+                fileobj.write(data)
+
+        if hole:
+            # Trailing hole, set the file size
+            fileobj.truncate()
+
+        return reader.byte_size
 
     @property
     def size_readable(self):
-        if self.inode.i_size < 1024:
-            return "{0:d} bytes".format(self.inode.i_size) if self.inode.i_size != 1 else "1 byte"
+        if self.size < 1024:
+            return "{0:d} bytes".format(self.size) if self.size != 1 else "1 byte"
         else:
             units = ["KiB", "MiB", "GiB", "TiB", "PiB", "EiB", "ZiB", "YiB"]
-            unit_idx = min(int(math.log(self.inode.i_size, 1024)), len(units))
+            unit_idx = min(int(math.log(self.size, 1024)), len(units))
 
-            return f"{self.inode.i_size / (1024 ** unit_idx):.2f} {units[unit_idx - 1]:s}"
+            return f"{self.size / (1024 ** unit_idx):.2f} {units[unit_idx - 1]:s}"
+
+    def xattrs(self, check_inline=True, check_block=True, force_inline=False, names=None):
+        # names: only yield these attributes
+        index = self.volume.index
+        if index is not None and check_inline and check_block and not force_inline and self.inode_idx in index.xattrs:
+            for xattr_name, xattr_value in index.xattrs[self.inode_idx]:
+                if names is None or xattr_name in names:
+                    yield xattr_name, xattr_value
+            return
 
-    def xattrs(self, check_inline=True, check_block=True, force_inline=False):
         # Inline xattrs
-        inline_data_offset = self.offset + ext4_inode.EXT2_GOOD_OLD_INODE_SIZE + self.inode.i_extra_isize
+        inline_data_offset = self.offset + ext4_inode.EXT2_GOOD_OLD_INODE_SIZE + self.extra_isize
         inline_data_length = self.offset + self.volume.superblock.s_inode_size - inline_data_offset
 
-        if check_inline and inline_data_length > ctypes.sizeof(ext4_xattr_ibody_header):
+        if check_inline and inline_data_length > xattr_magic_decoder.size:
             inline_data = self.volume.read(inline_data_offset, inline_data_length)
-            xattrs_header = ext4_xattr_ibody_header.from_buffer_copy(inline_data)
+            h_magic, = xattr_magic_decoder.unpack_from(inline_data)
 
             # TODO Find way to detect inline xattrs without checking the h_magic field to enable error detection with
             #  the h_magic field.
-            if force_inline or xattrs_header.h_magic == 0xEA020000:
-                offset = 4 * ((ctypes.sizeof(
-                    ext4_xattr_ibody_header) + 3) // 4)
+            if force_inline or h_magic == 0xEA020000:
+                offset = 4 * ((xattr_magic_decoder.size + 3) // 4)
                 # The ext4_xattr_entry following the header is aligned on a 4-byte boundary
             try:
-                for xattr_name, xattr_value in self._parse_xattrs(inline_data[offset:], 0):
+                for xattr_name, xattr_value in self._parse_xattrs(inline_data[offset:], 0, names):
                     yield xattr_name, xattr_value
             except BaseException and Exception:
                 ...
         # xattr block(s)
-        if check_block and self.inode.i_file_acl != 0:
-            xattrs_block_start = self.inode.i_file_acl * self.volume.block_size
-            xattrs_block = self.volume.read(xattrs_block_start, self.volume.block_size)
-
-            xattrs_header = ext4_xattr_header.from_buffer_copy(xattrs_block)
-            if not self.volume.ignore_magic and xattrs_header.h_magic != 0xEA020000:
-                try:
-                    raise MagicError(
-                        f"Invalid magic value in xattrs block header at offset 0x{xattrs_block_start:X} of "
-                        f"inode {self.inode_idx:d}: 0x{xattrs_header.h_magic} (expected 0xEA020000)"
-                    )
-                except BaseException and Exception:
-                    ...
-
-            if xattrs_header.h_blocks != 1:
-                raise Ext4Error(
-                    f"Invalid number of xattr blocks at offset 0x{xattrs_block_start:X} "
-                    f"of inode {self.inode_idx:d}: {xattrs_header.h_blocks:d} (expected 1)")
-
-            offset = 4 * ((ctypes.sizeof(
-                ext4_xattr_header) + 3) // 4)
-            # The ext4_xattr_entry following the header is aligned on a 4-byte boundary
-            for xattr_name, xattr_value in self._parse_xattrs(xattrs_block[offset:], -offset):
-                yield xattr_name, xattr_value
+        if check_block and self.file_acl != 0:
+            for xattr_name, xattr_value in self._xattr_block():
+                if names is None or xattr_name in names:
+                    yield xattr_name, xattr_value
+
+    def get_xattr(self, name, default=None):
+        # Stops parsing as soon as name is found
+        for _, xattr_value in self.xattrs(names=(name,)):
+            return xattr_value
+        return default
+
+    def _xattr_block(self):
+        volume = self.volume
+        with volume.xattr_cache_lock:
+            xattrs = volume.xattr_cache.get(self.file_acl)
+            if xattrs is not None:
+                volume.xattr_cache.move_to_end(self.file_acl)
+                return xattrs
+
+        xattrs_block_start = self.file_acl * volume.block_size
+        xattrs_block = volume.read(xattrs_block_start, volume.block_size)
+
+        h_magic, h_blocks = xattr_header_decoder.unpack_from(xattrs_block)
+        if not volume.ignore_magic and h_magic != 0xEA020000:
+            try:
+                raise MagicError(
+                    f"Invalid magic value in xattrs block header at offset 0x{xattrs_block_start:X} of "
+                    f"inode {self.inode_idx:d}: 0x{h_magic} (expected 0xEA020000)"
+                )
+            except BaseException and Exception:
+                ...
+
+        if h_blocks != 1:
+            raise Ext4Error(
+                f"Invalid number of xattr blocks at offset 0x{xattrs_block_start:X} "
+                f"of inode {self.inode_idx:d}: {h_blocks:d} (expected 1)")
+
+        offset = 4 * ((ctypes.sizeof(
+            ext4_xattr_header) + 3) // 4)
+        # The ext4_xattr_entry following the header is aligned on a 4-byte boundary
+        xattrs = tuple(self._parse_xattrs(xattrs_block[offset:], -offset))
+
+        with volume.xattr_cache_lock:
+            volume.xattr_cache[self.file_acl] = xattrs
+            while len(volume.xattr_cache) > volume.xattr_cache_size:
+                volume.xattr_cache.popitem(last=False)
+        return xattrs
 
 
 class BlockReader:
+    """
+    File-like reader over the blocks of an inode.
+
+    read_at() does not touch the cursor and may be called from many threads. read(), seek() and tell() share the
+    cursor; they are serialized by a lock, but threads sharing one reader should use read_at().
+    """
     # OSError
     EINVAL = 22
 
-    def __init__(self, volume, byte_size, block_map):
+    CHUNK_SIZE = 1 << 20  # Default chunk size of iter_chunks() and Inode.copy_to()
+
+    def __init__(self, volume, byte_size, block_map, metadata=False):
         self.byte_size = byte_size
         self.volume = volume
+        self.metadata = metadata  # Directory content, goes through the volume's block cache
 
         self.cursor = 0
+        self.lock = threading.Lock()
 
         block_map = list(map(MappingEntry.copy, block_map))
 
@@ -867,62 +1452,106 @@ class BlockReader:
         MappingEntry.optimize(block_map)
         self.block_map = block_map
 
+        # Sorted extent index for bisect lookups
+        self.extent_file_blocks = array.array("Q", (entry.file_block_idx for entry in block_map))
+        self.extent_disk_blocks = array.array("Q", (entry.disk_block_idx for entry in block_map))
+        self.extent_block_counts = array.array("Q", (entry.block_count for entry in block_map))
+
     def __repr__(self):
         return f"{type(self).__name__:s}(byte_size = {self.byte_size!r:s}, block_map = {self.block_map!r:s}, volume_uuid = {self.volume.uuid!r:s})"
 
     def get_block_mapping(self, file_block_idx):
-        disk_block_idx = None
+        idx = bisect.bisect_right(self.extent_file_blocks, file_block_idx) - 1
 
-        # Find disk block
-        for entry in self.block_map:
-            if entry.file_block_idx <= file_block_idx < entry.file_block_idx + entry.block_count:
-                block_diff = file_block_idx - entry.file_block_idx
-                disk_block_idx = entry.disk_block_idx + block_diff
-                break
+        if idx >= 0 and file_block_idx < self.extent_file_blocks[idx] + self.extent_block_counts[idx]:
+            return self.extent_disk_blocks[idx] + file_block_idx - self.extent_file_blocks[idx]
+
+        return None
+
+    def get_runs(self, offset, byte_len):
+        # Yields (disk_offset, length) pieces covering the byte range, disk_offset is None for unmapped ranges
+        block_size = self.volume.block_size
+        end = offset + byte_len
+        idx = bisect.bisect_right(self.extent_file_blocks, offset // block_size) - 1
+
+        while offset < end:
+            extent_end = (self.extent_file_blocks[idx] + self.extent_block_counts[idx]) * block_size if idx >= 0 else 0
+
+            if offset < extent_end:
+                run_end = min(end, extent_end)
+                yield (self.extent_disk_blocks[idx] - self.extent_file_blocks[idx]) * block_size + offset, run_end - offset
+            else:
+                # Sparse range up to the next extent
+                idx += 1
+                run_end = min(end, self.extent_file_blocks[idx] * block_size) if idx < len(
+                    self.extent_file_blocks) else end
+                if run_end > offset:
+                    yield None, run_end - offset
 
-        return disk_block_idx
+            offset = run_end
 
     def read(self, byte_len=-1):
+        with self.lock:
+            result = self.read_at(self.cursor, byte_len)
+            self.cursor += len(result)
+            return result
+
+    def read_at(self, offset, byte_len=-1):
         # Parse args
         if byte_len < -1:
             raise ValueError("byte_len must be non-negative or -1")
 
-        bytes_remaining = self.byte_size - self.cursor
+        bytes_remaining = self.byte_size - offset
         byte_len = bytes_remaining if byte_len == -1 else max(0, min(byte_len, bytes_remaining))
 
-        if byte_len == 0:
+        if byte_len <= 0:
             return b""
 
-        # Reading blocks
-        start_block_idx = self.cursor // self.volume.block_size
-        end_block_idx = (self.cursor + byte_len - 1) // self.volume.block_size
-        end_of_stream_check = byte_len
-
-        blocks = [self.read_block(i) for i in range(start_block_idx, end_block_idx - start_block_idx + 1)]
-
-        start_offset = self.cursor % self.volume.block_size
-        if start_offset != 0:
-            blocks[0] = blocks[0][start_offset:]
-        byte_len = (byte_len + start_offset - self.volume.block_size - 1) % self.volume.block_size + 1
-        blocks[-1] = blocks[-1][:byte_len]
-
-        result = b"".join(blocks)
+        # One read per contiguous run
+        result = b"".join(
+            bytes(run_len) if disk_offset is None else self.volume.read(disk_offset, run_len, self.metadata)
+            for disk_offset, run_len in self.get_runs(offset, byte_len))
 
         # Check read
-        if len(result) != end_of_stream_check:
+        if len(result) != byte_len:
             raise EndOfStreamError(
                 "The volume's underlying stream ended {0:d} bytes before EOF.".format(byte_len - len(result)))
 
-        self.cursor += len(result)
         return result
 
+    def readinto(self, buffer):
+        view = memoryview(buffer).cast("B")
+
+        with self.lock:
+            byte_len = max(0, min(len(view), self.byte_size - self.cursor))
+            pos = 0
+            for disk_offset, run_len in self.get_runs(self.cursor, byte_len):
+                if disk_offset is None:
+                    view[pos:pos + run_len] = bytes(run_len)
+                else:
+                    data = self.volume.read(disk_offset, run_len, self.metadata)
+                    if len(data) != run_len:
+                        raise EndOfStreamError(
+                            "The volume's underlying stream ended {0:d} bytes before EOF.".format(run_len - len(data)))
+                    view[pos:pos + run_len] = data
+                pos += run_len
+
+            self.cursor += pos
+            return pos
+
+    def iter_chunks(self, chunk_size=None, offset=0):
+        # Yields the content from offset on in pieces of at most chunk_size bytes, does not move the cursor
+        chunk_size = chunk_size or BlockReader.CHUNK_SIZE
+        for chunk_offset in range(offset, self.byte_size, chunk_size):
+            yield self.read_at(chunk_offset, chunk_size)
+
     def read_block(self, file_block_idx):
         disk_block_idx = self.get_block_mapping(file_block_idx)
 
         if disk_block_idx is not None:
-            return self.volume.read(disk_block_idx * self.volume.block_size, self.volume.block_size)
+            return self.volume.read(disk_block_idx * self.volume.block_size, self.volume.block_size, self.metadata)
         else:
-            return bytes([0] * self.volume.block_size)
+            return bytes(self.volume.block_size)
 
     def seek(self, seek, seek_mode=io.SEEK_SET):
         if seek_mode == io.SEEK_CUR:
@@ -935,7 +1564,8 @@ class BlockReader:
         if seek < 0:
             raise OSError(BlockReader.EINVAL, "Invalid argument")  # Exception behavior copied from IOBase.seek
 
-        self.cursor = seek
+        with self.lock:
+            self.cursor = seek
         return seek
 
     def tell(self):
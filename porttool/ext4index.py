@@ -0,0 +1,173 @@
+import hashlib
+import os
+import sqlite3
+
+from porttool import ext4
+
+# Sidecar index of an ext4 image (system.img -> system.img.idx): the whole directory tree with inode metadata, extent
+# runs, xattrs and symlink targets. A Volume opened with it lists, looks up and maps files without parsing any
+# directory, extent tree or xattr block of the image.
+
+INDEX_SUFFIX = '.idx'
+INDEX_VERSION = 1
+HEADER_SIZE = 64 * 1024  # Image head hashed into the key, covers the superblock and group descriptors
+
+SCHEMA = '''
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE inodes (inode INTEGER PRIMARY KEY, mode INTEGER, uid INTEGER, gid INTEGER, size INTEGER,
+                     flags INTEGER, links_count INTEGER, file_acl INTEGER, link_target TEXT, has_xattrs INTEGER);
+CREATE TABLE dirents (parent INTEGER, seq INTEGER, name BLOB, inode INTEGER, type INTEGER, PRIMARY KEY (parent, seq));
+CREATE TABLE extents (inode INTEGER, seq INTEGER, file_block INTEGER, disk_block INTEGER, block_count INTEGER,
+                      PRIMARY KEY (inode, seq));
+CREATE TABLE xattrs (inode INTEGER, seq INTEGER, name TEXT, value BLOB, PRIMARY KEY (inode, seq));
+'''
+
+
+def index_key(image_path):
+    # Changes whenever the image is rewritten: size, mtime and a hash of its head
+    st = os.stat(image_path)
+    with open(image_path, 'rb') as f:
+        header_hash = hashlib.sha1(f.read(HEADER_SIZE)).hexdigest()
+    return f'{INDEX_VERSION}:{st.st_size}:{st.st_mtime_ns}:{header_hash}'
+
+
+class Ext4Index:
+    def __init__(self):
+        self.inodes = {}  # inode -> ext4.InodeRecord
+        self.children = {}  # directory inode -> [(raw name, inode, file type), ...] in on-disk order
+        self.names = {}  # (directory inode, raw name) -> (inode, file type)
+        self.paths = {}  # "system/build.prop" -> (inode, file type)
+        self.extents = {}  # inode -> [(file block, disk block, block count), ...]
+        self.xattrs = {}  # inode -> ((name, value), ...)
+        self.link_targets = {}  # inode -> symlink target
+
+    def __index_names(self):
+        # Fills names and paths from children
+        for parent, entries in self.children.items():
+            for raw_name, inode_idx, file_type in entries:
+                self.names.setdefault((parent, raw_name), (inode_idx, file_type))
+
+        pending = [(ext4.Volume.ROOT_INODE, '')]
+        seen = {ext4.Volume.ROOT_INODE}
+        while pending:
+            parent, dir_path = pending.pop()
+            for raw_name, inode_idx, file_type in self.children.get(parent, ()):
+                if raw_name in (b'.', b'..') or inode_idx == 0:
+                    continue
+                try:
+                    path = dir_path + '/' + raw_name.decode('utf8') if dir_path else raw_name.decode('utf8')
+                except UnicodeDecodeError:
+                    continue
+                self.paths.setdefault(path, (inode_idx, file_type))
+                if inode_idx not in seen and inode_idx in self.children:
+                    seen.add(inode_idx)
+                    pending.append((inode_idx, path))
+
+    def __add_inode(self, inode):
+        self.inodes[inode.inode_idx] = ext4.InodeRecord(inode.mode, inode.uid, inode.gid, inode.size, inode.flags,
+                                                        inode.links_count, inode.file_acl)
+        try:
+            self.xattrs[inode.inode_idx] = tuple(inode.xattrs())
+        except ext4.Ext4Error:
+            ...
+        if inode.flags & ext4.ext4_inode.EXT4_EXTENTS_FL:
+            self.extents[inode.inode_idx] = [(entry.file_block_idx, entry.disk_block_idx, entry.block_count)
+                                             for entry in inode.extent_mapping()]
+        if inode.is_symlink:
+            try:
+                self.link_targets[inode.inode_idx] = inode.link_target
+            except Exception and BaseException:
+                ...
+
+    @classmethod
+    def build(cls, volume):
+        # One walk over the whole tree, the volume must not have an index yet
+        index = cls()
+        pending = [volume.root]
+        index.__add_inode(pending[0])
+        while pending:
+            dir_inode = pending.pop()
+            entries = index.children[dir_inode.inode_idx] = list(dir_inode.open_dir(decode_name=bytes))
+            for raw_name, inode_idx, file_type in entries:
+                if raw_name in (b'.', b'..') or inode_idx == 0 or inode_idx in index.inodes:
+                    # Self, parent, deleted entry, hard link or loop
+                    continue
+                inode = volume.get_inode(inode_idx, file_type)
+                index.__add_inode(inode)
+                if inode.is_dir:
+                    pending.append(inode)
+        index.__index_names()
+        return index
+
+    def save(self, index_path, key):
+        tmp_path = index_path + '.tmp'
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        with sqlite3.connect(tmp_path) as db:
+            db.executescript(SCHEMA)
+            db.execute('INSERT INTO meta VALUES (?, ?)', ('key', key))
+            db.executemany('INSERT INTO inodes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                           ((inode_idx, *record, self.link_targets.get(inode_idx), inode_idx in self.xattrs)
+                            for inode_idx, record in self.inodes.items()))
+            db.executemany('INSERT INTO dirents VALUES (?, ?, ?, ?, ?)',
+                           ((parent, seq, raw_name, inode_idx, file_type)
+                            for parent, entries in self.children.items()
+                            for seq, (raw_name, inode_idx, file_type) in enumerate(entries)))
+            db.executemany('INSERT INTO extents VALUES (?, ?, ?, ?, ?)',
+                           ((inode_idx, seq, *extent) for inode_idx, extents in self.extents.items()
+                            for seq, extent in enumerate(extents)))
+            db.executemany('INSERT INTO xattrs VALUES (?, ?, ?, ?)',
+                           ((inode_idx, seq, name, value) for inode_idx, xattrs in self.xattrs.items()
+                            for seq, (name, value) in enumerate(xattrs)))
+        db.close()
+        os.replace(tmp_path, index_path)
+
+    @classmethod
+    def load(cls, index_path, key):
+        # None if the index is missing, unreadable or belongs to another image
+        if not os.path.isfile(index_path):
+            return None
+        try:
+            db = sqlite3.connect(f'file:{index_path}?mode=ro', uri=True)
+        except sqlite3.Error:
+            return None
+        try:
+            if db.execute('SELECT value FROM meta WHERE key = ?', ('key',)).fetchone() != (key,):
+                return None
+            index = cls()
+            for inode_idx, *record, link_target, has_xattrs in db.execute('SELECT * FROM inodes'):
+                index.inodes[inode_idx] = ext4.InodeRecord(*record)
+                if link_target is not None:
+                    index.link_targets[inode_idx] = link_target
+                if has_xattrs:
+                    index.xattrs[inode_idx] = ()
+            for inode_idx, name, value in db.execute('SELECT inode, name, value FROM xattrs ORDER BY inode, seq'):
+                index.xattrs[inode_idx] += ((name, value),)
+            for inode_idx, *extent in db.execute(
+                    'SELECT inode, file_block, disk_block, block_count FROM extents ORDER BY inode, seq'):
+                index.extents.setdefault(inode_idx, []).append(tuple(extent))
+            for parent, raw_name, inode_idx, file_type in db.execute(
+                    'SELECT parent, name, inode, type FROM dirents ORDER BY parent, seq'):
+                index.children.setdefault(parent, []).append((bytes(raw_name), inode_idx, file_type))
+            index.__index_names()
+            return index
+        except sqlite3.Error:
+            return None
+        finally:
+            db.close()
+
+
+def load_index(image_path):
+    # The index next to image_path if it is still valid for the image, None otherwise
+    return Ext4Index.load(image_path + INDEX_SUFFIX, index_key(image_path))
+
+
+def build_index(volume, image_path):
+    # Builds the index of the volume opened from image_path and writes it next to the image for the next run
+    index = Ext4Index.build(volume)
+    index_path = image_path + INDEX_SUFFIX
+    try:
+        index.save(index_path, index_key(image_path))
+    except (OSError, sqlite3.Error) as e:
+        print(f'[W] Cannot write {index_path}, Because of {e}')
+    return index
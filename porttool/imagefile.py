@@ -0,0 +1,64 @@
+import abc
+import os
+import threading
+
+
+class ImageFile(abc.ABC):
+    """
+    Read-only, random-access file object over a virtual image stored in another file.
+
+    Subclasses only map image offsets to the backing file in read_at(), which must not use the shared cursor so it
+    can be called from several threads (e.g. by ext4.Volume). read() / seek() / tell() and the context manager are
+    built on it.
+    """
+
+    def __init__(self, file, size):
+        self.file = file
+        self.size = size
+        self.pos = 0
+        self.lock = threading.Lock()
+        self.file_lock = threading.Lock()
+        self.fd = file.fileno() if hasattr(os, 'pread') else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    def _pread(self, filepos, length):
+        # Exactly length bytes of the backing file, a short read would shift everything read_at() joins after it
+        if self.fd is not None:
+            data = os.pread(self.fd, length, filepos)
+        else:
+            with self.file_lock:
+                self.file.seek(filepos, os.SEEK_SET)
+                data = self.file.read(length)
+        if len(data) < length:
+            raise EOFError('{} ended {} bytes early at offset {}'.format(
+                getattr(self.file, 'name', 'Image'), length - len(data), filepos + len(data)))
+        return data
+
+    @abc.abstractmethod
+    def read_at(self, offset, length=-1):
+        ...
+
+    def read(self, length=-1):
+        with self.lock:
+            data = self.read_at(self.pos, length)
+            self.pos += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self.pos = offset
+        return offset
+
+    def tell(self):
+        return self.pos
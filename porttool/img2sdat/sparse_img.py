@@ -18,6 +18,7 @@ import sys
 import struct
 from hashlib import sha1
 
+from porttool.imagefile import ImageFile
 from . import rangelib
 
 
@@ -287,3 +288,47 @@ class SparseImage(object):
         """Throw away the file map and treat the entire image as
     undifferentiated data."""
         self.file_map = {"__DATA": self.care_map}
+
+
+class SparseImageFile(ImageFile):
+    """Read-only, random-access file object over the logical content of a
+  SparseImage.
+
+  RAW chunks map to offsets in the sparse file, FILL chunks are synthesized
+  and DONT_CARE ranges read as zeros, so the image can be used (e.g. by
+  ext4.Volume) without converting it with simg2img first. read_at() does not
+  use the shared cursor and may be called from several threads."""
+
+    def __init__(self, simg):
+        self.simg = simg
+        self.blocksize = simg.blocksize
+        ImageFile.__init__(self, simg.simg_f, simg.total_blocks * simg.blocksize)
+
+    def read_at(self, offset, length=-1):
+        end = self.size if length < 0 else min(self.size, offset + length)
+        offset_index = self.simg.offset_index
+        idx = bisect.bisect_right(offset_index, offset // self.blocksize) - 1
+        data = []
+
+        while offset < end:
+            chunk_start, chunk_len, filepos, fill_data = self.simg.offset_map[idx] if idx >= 0 else (0, 0, None, None)
+            chunk_end = (chunk_start + chunk_len) * self.blocksize
+
+            if offset < chunk_end:
+                run_end = min(end, chunk_end)
+                if filepos is not None:
+                    data.append(self._pread(filepos + offset - chunk_start * self.blocksize, run_end - offset))
+                else:
+                    # Chunks are block aligned, so the fill pattern phase only depends on the offset
+                    phase = offset % 4
+                    data.append((fill_data * ((run_end - offset + phase) // 4 + 1))[phase:phase + run_end - offset])
+            else:
+                # DONT_CARE up to the next chunk
+                idx += 1
+                run_end = min(end, offset_index[idx] * self.blocksize) if idx < len(offset_index) else end
+                if run_end > offset:
+                    data.append(bytes(run_end - offset))
+
+            offset = run_end
+
+        return b"".join(data)
@@ -1,16 +1,115 @@
+import fnmatch
+import hashlib
+import heapq
+import itertools
 import os
 import re
+import shutil
 import struct
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
-from porttool import ext4
+from porttool import ext4, ext4index
+from porttool.img2sdat import sparse_img
+from porttool.sdat2img import TransferListImage
 if os.name == 'nt':
     from ctypes.wintypes import LPCSTR, DWORD
     from stat import FILE_ATTRIBUTE_SYSTEM
     from ctypes import windll
+else:
+    import fcntl
+
+
+class LineWriter:
+    # Appends lines to a text file through one buffered handle, the file is created by the first line
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def write(self, line):
+        if self.file is None:
+            self.file = open(self.path, 'a', newline='\n')
+        self.file.write(line)
+        self.file.write('\n')
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class SortedLines:
+    # Collects lines and iterates them sorted, every spill_lines lines are sorted and spilled to a temporary file
+    # and merged back on iteration, so memory stays bounded
+    SPILL_LINES = 100000
+    READ_SIZE = 1 << 20
+
+    def __init__(self, spill_lines=SPILL_LINES):
+        self.spill_lines = spill_lines
+        self.lines = []
+        self.runs = []
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, line):
+        self.lines.append(line)
+        self.count += 1
+        if len(self.lines) >= self.spill_lines:
+            self.lines.sort()
+            run = tempfile.TemporaryFile('w+', encoding='utf-8', newline='')
+            # NUL cannot be part of a path or a context, lines may contain anything else
+            for line in self.lines:
+                run.write(line)
+                run.write('\0')
+            self.runs.append(run)
+            self.lines = []
+
+    def __read_run(self, run):
+        run.seek(0)
+        rest = ''
+        for chunk in iter(lambda: run.read(self.READ_SIZE), ''):
+            *lines, rest = (rest + chunk).split('\0')
+            yield from lines
+
+    def __iter__(self):
+        self.lines.sort()
+        return heapq.merge(*map(self.__read_run, self.runs), self.lines)
+
+    def close(self):
+        for run in self.runs:
+            run.close()
+        self.runs = []
+        self.lines = []
+        self.count = 0
 
 
 class Extractor:
-    def __init__(self):
+    SPARSE_MAGIC = b'\x3a\xff\x26\xed'  # 0xED26FF3A
+    NEW_DAT_SUFFIX = '.new.dat'
+    CONTEXT_ESCAPE = str.maketrans({c: '\\' + c for c in '\\^$.|?*+(){}[]'})
+    BUILD_PROP_CONTEXT = re.compile('/system/system/build..prop ')
+    LOST_FOUND_CONTEXT = re.compile('lost..found')
+    CONTEXT_HEAD = 5  # Sorted file_contexts lines the header lines can end up between
+
+    OPEN_FILES = 64  # Output files kept open by each worker of the physical order scheduler
+    READ_GAP = 64 * 1024  # Gaps between extents up to this size are read through by the scheduler instead of seeking
+    FICLONE = 0x40049409  # ioctl sharing the data extents of two files (btrfs, xfs, bcachefs, ...)
+
+    def __init__(self, chunk_size=ext4.BlockReader.CHUNK_SIZE, workers=1, physical_order=False, hardlinks=False,
+                 dedupe=None, use_index=False, sink=None):
+        # workers: threads copying file data (None: one per CPU), the directory walk and the config files stay
+        # sequential so the output does not depend on it
+        # physical_order: copy file data sorted by disk location, adjacent extents of different files are read at once
+        # hardlinks: inodes with several directory entries are written once and hard linked
+        # dedupe: 'hardlink' or 'reflink' files with the same content, mode and owner to the first copy. Hard links
+        # share later in place edits, only use them for trees that are not modified.
+        # use_index: read the tree from the image's .idx sidecar (ext4index), built on the first run
+        # sink: sinks.Sink receiving directories, files and symlinks (zip, tar, memory, ...) instead of the extract
+        # directory, files are streamed in directory order and workers, physical_order, hardlinks and dedupe do not
+        # apply. The config files are still written.
         self.OUTPUT_MYIMAGE_FILE = None
         self.MYFileName = None
         self.BASE_MY_DIR = None
@@ -19,15 +118,37 @@ class Extractor:
         self.DIR = None
         self.FileName = ""
         self.OUTPUT_IMAGE_FILE = ""
+        self.image = None
         self.EXTRACT_DIR = ""
-        self.context = []
-        self.fs_config = []
+        self.context = SortedLines()
+        self.context_firsts = {}  # Pattern -> first file_contexts line in sort order matching it
+        self.fs_config = None
+        self.space = None
+        self.chunk_size = chunk_size
+        self.paths = None
+        self.metadata_only = False
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        self.jobs = {}
+        self.physical_order = physical_order
+        self.stats = {}
+        self.hardlinks = hardlinks
+        self.dedupe = dedupe
+        self.inode_targets = {}
+        self.links = []
+        self.use_index = use_index
+        self.sink = sink
 
     @staticmethod
     def __out_name(file_path, out=1):
         name = file_path if out == 1 else os.path.basename(file_path).rsplit('.', 1)[0]
         return name.split('-')[0].split(' ')[0].split('+')[0].split('{')[0].split('(')[0]
 
+    @classmethod
+    def __image_name(cls, file_path):
+        # system.new.dat is extracted as if it was system.img
+        name = os.path.basename(file_path)
+        return name[:-len(cls.NEW_DAT_SUFFIX)] + '.img' if name.endswith(cls.NEW_DAT_SUFFIX) else name
+
     @staticmethod
     def __append(msg, log):
         if not os.path.isfile(log) and not os.path.exists(log):
@@ -36,75 +157,254 @@ class Extractor:
             print(msg, file=file)
 
     @staticmethod
-    def __get_perm(arg):
-        if len(arg) < 9 or len(arg) > 10:
-            return
-        if len(arg) > 8:
-            arg = arg[1:]
-        o = s = w = g = 0
-        perms = {
-            'r': 4,
-            'w': 2,
-            'x': 1
+    def __parse_patterns(paths):
+        # "lib/hw/*.so" -> ['lib', 'hw', '*.so'], same syntax as the glob patterns of portutils
+        if paths is None:
+            return None
+        return [parts for parts in ([part for part in path.replace('\\', '/').split('/') if part not in ('', '.')]
+                                    for path in paths) if parts]
+
+    @staticmethod
+    def __dir_entries(dir_inode, patterns):
+        if patterns is None or any(any(c in parts[0] for c in '*?[') for parts in patterns):
+            return dir_inode.open_dir()
+        # Only literal names left, resolve them through the directory index instead of reading the whole directory
+        return filter(lambda entry: entry[1] is not None,
+                      (dir_inode.lookup(name) for name in dict.fromkeys(parts[0] for parts in patterns)))
+
+    def __open_image(self):
+        if self.image is not None:
+            return self.image
+        # system.new.dat + system.transfer.list are read in place instead of being converted by sdat2img first
+        if self.OUTPUT_IMAGE_FILE.endswith(self.NEW_DAT_SUFFIX):
+            return TransferListImage(self.OUTPUT_IMAGE_FILE[:-len(self.NEW_DAT_SUFFIX)] + '.transfer.list',
+                                     self.OUTPUT_IMAGE_FILE)
+        # Android sparse images are read in place instead of being converted by simg2img first
+        with open(self.OUTPUT_IMAGE_FILE, 'rb') as f:
+            magic = f.read(4)
+        if magic == self.SPARSE_MAGIC:
+            return sparse_img.SparseImageFile(sparse_img.SparseImage(self.OUTPUT_IMAGE_FILE))
+        return open(self.OUTPUT_IMAGE_FILE, 'rb')
+
+    def __write_file(self, file_target, entry_inode, mode, uid, gid):
+        try:
+            with open(file_target, 'wb') as out:
+                entry_inode.copy_to(out, self.chunk_size)
+        except Exception and BaseException as e:
+            print(f'[E] Cannot Write {file_target}, Because of {e}')
+        if os.name == 'posix' and os.geteuid() == 0:
+            os.chmod(file_target, int(mode, 8))
+            os.chown(file_target, uid, gid)
+
+    def __write_jobs(self):
+        # Volume reads are positional, every worker copies whole files on its own
+        jobs, self.jobs = self.jobs, {}
+        if self.dedupe:
+            self.__dedupe_jobs(jobs)
+        if jobs and self.physical_order:
+            self.__write_jobs_physical(jobs)
+        elif jobs:
+            with ThreadPoolExecutor(self.workers) as pool:
+                for _ in pool.map(lambda job: self.__write_file(job[0], *job[1]), jobs.items()):
+                    ...
+        self.__write_links()
+
+    def __content_hash(self, entry_inode):
+        digest = hashlib.sha256()
+        reader = entry_inode.open_read()
+        if isinstance(reader, ext4.BlockReader):
+            for chunk in reader.iter_chunks(self.chunk_size):
+                digest.update(chunk)
+        else:
+            digest.update(reader.read())
+        return digest.digest()
+
+    def __dedupe_jobs(self, jobs):
+        # Only files sharing size, mode and owner are hashed, duplicates are linked to the first one
+        groups = {}
+        for file_target, (entry_inode, mode, uid, gid) in jobs.items():
+            if entry_inode.size:
+                groups.setdefault((entry_inode.size, mode, uid, gid), []).append(file_target)
+        links = []
+        for file_targets in groups.values():
+            if len(file_targets) < 2:
+                continue
+            firsts = {}
+            for file_target in file_targets:
+                try:
+                    digest = self.__content_hash(jobs[file_target][0])
+                except Exception and BaseException as e:
+                    print(f'[E] Cannot Read {file_target}, Because of {e}')
+                    continue
+                if digest in firsts:
+                    links.append((firsts[digest], file_target, self.dedupe, jobs.pop(file_target)))
+                else:
+                    firsts[digest] = file_target
+        # Before the hard links of shared inodes, those may point to a deduplicated file
+        self.links[:0] = links
+
+    @classmethod
+    def reflink_supported(cls, directory):
+        # Whether files in directory can share extents, dedupe='reflink' only saves anything there
+        if os.name == 'nt':
+            return False
+        os.makedirs(directory, exist_ok=True)
+        with tempfile.TemporaryFile(dir=directory) as src, tempfile.TemporaryFile(dir=directory) as dst:
+            src.write(bytes(4096))
+            src.flush()
+            try:
+                fcntl.ioctl(dst.fileno(), cls.FICLONE, src.fileno())
+            except OSError:
+                return False
+        return True
+
+    def __reflink(self, src, dst):
+        # Falls back to a plain copy where the file system cannot share extents
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            try:
+                if os.name == 'nt':
+                    raise OSError
+                fcntl.ioctl(fdst.fileno(), self.FICLONE, fsrc.fileno())
+            except OSError:
+                shutil.copyfileobj(fsrc, fdst, self.chunk_size)
+
+    def __write_links(self):
+        links, self.links = self.links, []
+        for src, file_target, how, (entry_inode, mode, uid, gid) in links:
+            try:
+                if os.path.lexists(file_target):
+                    os.remove(file_target)
+                if how == 'reflink':
+                    self.__reflink(src, file_target)
+                else:
+                    try:
+                        os.link(src, file_target)
+                    except OSError:
+                        # No hard links here (FAT, ...), copy instead
+                        shutil.copyfile(src, file_target)
+            except Exception and BaseException as e:
+                print(f'[E] Cannot Write {file_target}, Because of {e}')
+            if os.name == 'posix' and os.geteuid() == 0:
+                os.chmod(file_target, int(mode, 8))
+                os.chown(file_target, uid, gid)
+
+    def __schedule_reads(self, jobs):
+        # Creates the output files and returns the reads covering all file data sorted by disk offset:
+        # [disk_offset, length, [(file_target, file_offset, read_offset, length), ...]], reads are at most chunk_size
+        # long. Small gaps (the tail of a file's last block, xattr blocks, ...) do not break a read, so small files
+        # packed next to each other are read at once.
+        segments = []
+        for file_target, (entry_inode, mode, uid, gid) in jobs.items():
+            try:
+                reader = entry_inode.open_read()
+                with open(file_target, 'wb') as out:
+                    if not isinstance(reader, ext4.BlockReader):
+                        # Inline data
+                        out.write(reader.read())
+                        continue
+                    # Unmapped ranges stay holes
+                    out.truncate(reader.byte_size)
+                file_offset = 0
+                for disk_offset, run_len in reader.get_runs(0, reader.byte_size):
+                    if disk_offset is not None:
+                        for piece in range(0, run_len, self.chunk_size):
+                            segments.append((disk_offset + piece, min(self.chunk_size, run_len - piece), file_target,
+                                             file_offset + piece))
+                    file_offset += run_len
+            except Exception and BaseException as e:
+                print(f'[E] Cannot Write {file_target}, Because of {e}')
+        segments.sort()
+
+        reads = []
+        for disk_offset, length, file_target, file_offset in segments:
+            last = reads[-1] if reads else None
+            if last and last[0] <= disk_offset <= last[0] + last[1] + self.READ_GAP and \
+                    disk_offset + length - last[0] <= self.chunk_size:
+                last[1] = max(last[1], disk_offset + length - last[0])
+                last[2].append((file_target, file_offset, disk_offset - last[0], length))
+            else:
+                reads.append([disk_offset, length, [(file_target, file_offset, 0, length)]])
+        return reads
+
+    def __copy_reads(self, volume, reads):
+        # Returns the number of reads starting at most READ_GAP bytes after the previous one
+        files = OrderedDict()
+        sequential = 0
+        end = None
+        try:
+            for disk_offset, length, pieces in reads:
+                sequential += end is not None and end <= disk_offset <= end + self.READ_GAP
+                end = disk_offset + length
+                data = volume.read(disk_offset, length, metadata=False)
+                for file_target, file_offset, pos, piece_len in pieces:
+                    try:
+                        out = files.pop(file_target, None) or open(file_target, 'r+b')
+                        files[file_target] = out
+                        if len(files) > self.OPEN_FILES:
+                            files.popitem(last=False)[1].close()
+                        if pos + piece_len > len(data):
+                            raise ext4.EndOfStreamError(
+                                "The volume's underlying stream ended {0:d} bytes before EOF.".format(
+                                    pos + piece_len - len(data)))
+                        out.seek(file_offset)
+                        out.write(data[pos:pos + piece_len])
+                    except Exception and BaseException as e:
+                        print(f'[E] Cannot Write {file_target}, Because of {e}')
+        finally:
+            for out in files.values():
+                out.close()
+        return sequential
+
+    def __write_jobs_physical(self, jobs):
+        volume = next(iter(jobs.values()))[0].volume
+        reads = self.__schedule_reads(jobs)
+        # Every worker takes one contiguous part of the disk
+        part = -(-len(reads) // self.workers) or 1
+        with ThreadPoolExecutor(self.workers) as pool:
+            sequential = sum(pool.map(lambda start: self.__copy_reads(volume, reads[start:start + part]),
+                                      range(0, len(reads), part)))
+        for file_target, (entry_inode, mode, uid, gid) in jobs.items():
+            if os.name == 'posix' and os.geteuid() == 0:
+                try:
+                    os.chmod(file_target, int(mode, 8))
+                    os.chown(file_target, uid, gid)
+                except Exception and BaseException as e:
+                    # Not created, __schedule_reads already reported it
+                    print(f'[E] Cannot set owner of {file_target}, Because of {e}')
+        self.stats = {
+            'files': len(jobs),
+            'bytes': sum(piece[3] for read in reads for piece in read[2]),
+            'reads': len(reads),
+            'sequential_reads': sequential,
+            'sequential_ratio': sequential / len(reads) if reads else 1.0,
         }
-        for n, sym in enumerate(arg):
-            if n == 0 and perms.get(sym):
-                o = perms.get(sym)
-            elif n == 1 and perms.get(sym):
-                o += perms.get(sym)
-            elif n == 2:
-                if sym == 'S':
-                    s = 4
-                elif perms.get(sym):
-                    o += perms.get(sym)
-                elif sym == 's':
-                    s += 4
-                    o += 1
-            elif n == 3 and perms.get(sym):
-                g = perms.get(sym)
-            elif n == 4 and perms.get(sym):
-                g += perms.get(sym)
-            if n == 5:
-                if perms.get(sym):
-                    g += perms.get(sym)
-                elif sym == 'S':
-                    s += 2
-                elif sym == 's':
-                    s += 2
-                    g += 1
-            elif n == 6 and perms.get(sym):
-                w = perms.get(sym)
-            elif n == 7 and perms.get(sym):
-                w += perms.get(sym)
-            elif n == 8:
-                if perms.get(sym):
-                    w += perms.get(sym)
-                elif sym == 'T':
-                    s += 1
-                elif sym == 't':
-                    s += 1
-                    w += 1
-        return f'{s}{o}{g}{w}'
 
     def __ext4extractor(self):
-        def scan_dir(root_inode, root_path=""):
-            for entry_name, entry_inode_idx, entry_type in root_inode.open_dir():
+        def scan_dir(root_inode, root_path="", patterns=None):
+            for entry_name, entry_inode_idx, entry_type in self.__dir_entries(root_inode, patterns):
                 if entry_name in ['.', '..'] or entry_name.endswith(' (2)'):
                     continue
+                sub_patterns = None
+                if patterns is not None:
+                    sub_patterns = [parts[1:] for parts in patterns if fnmatch.fnmatchcase(entry_name, parts[0])]
+                    if not sub_patterns:
+                        continue
+                    if not all(sub_patterns):
+                        # Matched completely, take the whole subtree
+                        sub_patterns = None
                 entry_inode = root_inode.volume.get_inode(entry_inode_idx, entry_type)
+                if sub_patterns is not None and not entry_inode.is_dir:
+                    continue
                 entry_inode_path = root_path + '/' + entry_name
-                mode = self.__get_perm(entry_inode.mode_str)
-                uid = entry_inode.inode.i_uid
-                gid = entry_inode.inode.i_gid
+                mode = perms[entry_inode_idx] if entry_inode_idx < len(perms) else entry_inode.perm_str
+                uid = entry_inode.uid
+                gid = entry_inode.gid
                 cap = ''
                 link_target = ''
                 tmp_path = self.DIR + entry_inode_path
-                for f, e in entry_inode.xattrs():
+                for f, e in entry_inode.xattrs(names=('security.selinux', 'security.capability')):
                     if f == 'security.selinux':
-                        t_p_mkc = tmp_path
-                        for fuk_ in '\\^$.|?*+(){}[]':
-                            t_p_mkc = t_p_mkc.replace(fuk_, '\\' + fuk_)
-                        self.context.append(f"/{t_p_mkc} {e.decode('utf8')[:-1]}")
+                        self.__add_context(f"/{tmp_path.translate(self.CONTEXT_ESCAPE)} {e.decode('utf8')[:-1]}")
                     elif f == 'security.capability':
                         r = struct.unpack('<5I', e)
                         if r[1] > 65535:
@@ -113,20 +413,28 @@ class Extractor:
                             cap = hex(int(f'{r[3]:04x}{r[2]:04x}{r[1]:04x}', 16))
                         cap = f" capabilities={cap}"
                 if entry_inode.is_symlink:
-                    try:
-                        link_target = entry_inode.open_read().read().decode("utf8")
-                    except Exception and BaseException:
-                        link_target_block = int.from_bytes(entry_inode.open_read().read(), "little")
-                        link_target = root_inode.volume.read(link_target_block * root_inode.volume.block_size,
-                                                             entry_inode.inode.i_size).decode("utf8")
+                    link_target = entry_inode.link_target
                 if tmp_path.find(' ', 1, len(tmp_path)) > 0:
-                    self.__append(tmp_path, os.path.join(self.CONFING_DIR, self.FileName + '_space.txt'))
-                    self.fs_config.append(
+                    self.space.write(tmp_path)
+                    self.fs_config.write(
                         f"{tmp_path.replace(' ', '_')} {uid} {gid} {mode}{cap} {link_target}")
                 else:
-                    self.fs_config.append(
+                    self.fs_config.write(
                         f'{tmp_path} {uid} {gid} {mode}{cap} {link_target}')
-                if entry_inode.is_dir:
+                if self.metadata_only:
+                    # Only the config files are wanted, no file data is read and nothing is written to EXTRACT_DIR
+                    if entry_inode.is_dir:
+                        scan_dir(entry_inode, entry_inode_path, sub_patterns)
+                elif self.sink is not None:
+                    sink_path = entry_inode_path.replace(' ', '_').replace('"', '').lstrip('/')
+                    if entry_inode.is_dir:
+                        self.sink.mkdir(sink_path, int(mode, 8), uid, gid)
+                        scan_dir(entry_inode, entry_inode_path, sub_patterns)
+                    elif entry_inode.is_file:
+                        self.sink.write_file(sink_path, entry_inode, int(mode, 8), uid, gid)
+                    elif entry_inode.is_symlink:
+                        self.sink.symlink(sink_path, link_target, uid, gid)
+                elif entry_inode.is_dir:
                     dir_target = self.EXTRACT_DIR + entry_inode_path.replace(' ', '_').replace('"', '')
                     if dir_target.endswith('.') and os.name == 'nt':
                         dir_target = dir_target[:-1]
@@ -135,19 +443,25 @@ class Extractor:
                     if os.name == 'posix' and os.geteuid() == 0:
                         os.chmod(dir_target, int(mode, 8))
                         os.chown(dir_target, uid, gid)
-                    scan_dir(entry_inode, entry_inode_path)
+                    scan_dir(entry_inode, entry_inode_path, sub_patterns)
                 elif entry_inode.is_file:
                     file_target = self.EXTRACT_DIR + entry_inode_path.replace(' ', '_').replace('"', '')
-                    try:
-                        with open(file_target, 'wb') as out:
-                            out.write(entry_inode.open_read().read())
-                    except Exception and BaseException as e:
-                        print(f'[E] Cannot Write {file_target}, Because of {e}')
-                    if os.name == 'posix' and os.geteuid() == 0:
-                        os.chmod(file_target, int(mode, 8))
-                        os.chown(file_target, uid, gid)
+                    if self.hardlinks and entry_inode.links_count > 1:
+                        if entry_inode_idx in self.inode_targets:
+                            self.links.append((self.inode_targets[entry_inode_idx], file_target, 'hardlink',
+                                               (entry_inode, mode, uid, gid)))
+                            continue
+                        self.inode_targets[entry_inode_idx] = file_target
+                    if self.workers > 1 or self.physical_order or self.dedupe:
+                        # Copied by the pool once the walk is done, a later entry with the same target wins like
+                        # it does when writing sequentially
+                        self.jobs.pop(file_target, None)
+                        self.jobs[file_target] = (entry_inode, mode, uid, gid)
+                    else:
+                        self.__write_file(file_target, entry_inode, mode, uid, gid)
                 elif entry_inode.is_symlink:
                     target = self.EXTRACT_DIR + entry_inode_path.replace(' ', '_')
+                    self.jobs.pop(target, None)
                     try:
                         if os.path.islink(target) or os.path.isfile(target):
                             try:
@@ -182,32 +496,78 @@ class Extractor:
 
         if not os.path.isdir(self.CONFING_DIR):
             os.makedirs(self.CONFING_DIR)
-        self.__append(os.path.getsize(self.OUTPUT_IMAGE_FILE), self.CONFING_DIR + os.sep + self.FileName + '_size.txt')
-        with open(self.OUTPUT_IMAGE_FILE, 'rb') as file:
-            dir_r = self.__out_name(os.path.basename(self.OUTPUT_IMAGE_FILE).rsplit('.', 1)[0])
+        with self.__open_image() as file:
+            self.__append(getattr(file, 'size', None) or os.path.getsize(self.OUTPUT_IMAGE_FILE),
+                          self.CONFING_DIR + os.sep + self.FileName + '_size.txt')
+            dir_r = self.__out_name(self.__image_name(self.OUTPUT_IMAGE_FILE).rsplit('.', 1)[0])
             self.DIR = dir_r
-            scan_dir(ext4.Volume(file).root)
-            self.fs_config.insert(0, '/ 0 2000 0755' if dir_r == 'vendor' else '/ 0 0 0755')
-            self.fs_config.insert(1, f'{dir_r} 0 2000 0755' if dir_r == 'vendor' else '/lost+found 0 0 0700')
-            self.fs_config.insert(2 if dir_r == 'system' else 1, f'{dir_r} 0 0 0755')
-            self.__append('\n'.join(self.fs_config), self.CONFING_DIR + os.sep + self.FileName + '_fs_config')
-            p1 = p2 = 0
-            if self.context:
-                self.context.sort()
-                for c in self.context:
-                    if re.search('/system/system/build..prop ', c) and p1 == 0:
-                        self.context.insert(3, '/lost+\\found u:object_r:rootfs:s0')
-                        self.context.insert(4, f'/{dir_r}/{dir_r}/(/.*)? ' + c.split()[1])
-                        p1 = 1
-                    if re.search('lost..found', c) and p2 == 0:
-                        self.context.insert(0, '/ ' + c.split()[1])
-                        self.context.insert(1, f'/{dir_r}(/.*)? ' + c.split()[1])
-                        self.context.insert(2, f'/{dir_r} {c.split()[1]}')
-                        self.context.insert(3, f'/{dir_r}/lost+\\found ' + c.split()[1])
-                        p2 = 1
-                    if p1 == p2 == 1:
-                        break
-                self.__append('\n'.join(self.context), self.CONFING_DIR + os.sep + self.FileName + "_file_contexts")
+            self.inode_targets = {}
+            self.fs_config = LineWriter(self.CONFING_DIR + os.sep + self.FileName + '_fs_config')
+            self.space = LineWriter(os.path.join(self.CONFING_DIR, self.FileName + '_space.txt'))
+            self.context = SortedLines()
+            self.context_firsts = {}
+            volume = None
+            try:
+                # The sidecar index is keyed to the image file, an image passed in may not have one
+                use_index = self.use_index and self.image is None
+                index = ext4index.load_index(self.OUTPUT_IMAGE_FILE) if use_index else None
+                volume = ext4.Volume(file, use_mmap=True, bulk_inodes=index is None, index=index)
+                if use_index and index is None:
+                    volume.index = ext4index.build_index(volume, self.OUTPUT_IMAGE_FILE)
+                # Permission strings of all inodes at once when the volume has the columnar inode table
+                perms = volume.inode_table.permission_strings() if volume.inode_table is not None else ()
+                if dir_r == 'system':
+                    fs_config_header = ('/ 0 0 0755', '/lost+found 0 0 0700', 'system 0 0 0755')
+                elif dir_r == 'vendor':
+                    fs_config_header = ('/ 0 2000 0755', 'vendor 0 0 0755', 'vendor 0 2000 0755')
+                else:
+                    fs_config_header = ('/ 0 0 0755', f'{dir_r} 0 0 0755', '/lost+found 0 0 0700')
+                for line in fs_config_header:
+                    self.fs_config.write(line)
+                scan_dir(volume.root, "", self.__parse_patterns(self.paths))
+                self.__write_jobs()
+                if self.context:
+                    contexts = LineWriter(self.CONFING_DIR + os.sep + self.FileName + "_file_contexts")
+                    for line in self.__contexts(dir_r):
+                        contexts.write(line)
+                    contexts.close()
+            finally:
+                self.fs_config.close()
+                self.space.close()
+                self.context.close()
+                # Unmapped before the image is closed, so it can be deleted or overwritten right away
+                if volume is not None:
+                    volume.close()
+
+    def __add_context(self, line):
+        self.context.append(line)
+        for pattern in (self.BUILD_PROP_CONTEXT, self.LOST_FOUND_CONTEXT):
+            if pattern.search(line) and (pattern not in self.context_firsts or line < self.context_firsts[pattern]):
+                self.context_firsts[pattern] = line
+
+    def __contexts(self, dir_r):
+        # Sorted file_contexts lines with the header lines injected. Those only ever land in front of the first
+        # CONTEXT_HEAD lines, so the injection runs on that head plus the lines triggering it, the rest is streamed.
+        lines = iter(self.context)
+        head = list(itertools.islice(lines, self.CONTEXT_HEAD))
+        triggers = sorted(set(line for line in self.context_firsts.values() if line > head[-1]))
+        context = head + triggers
+        p1 = p2 = 0
+        for c in context:
+            if self.BUILD_PROP_CONTEXT.search(c) and p1 == 0:
+                context.insert(3, '/lost+\\found u:object_r:rootfs:s0')
+                context.insert(4, f'/{dir_r}/{dir_r}/(/.*)? ' + c.split()[1])
+                p1 = 1
+            if self.LOST_FOUND_CONTEXT.search(c) and p2 == 0:
+                context.insert(0, '/ ' + c.split()[1])
+                context.insert(1, f'/{dir_r}(/.*)? ' + c.split()[1])
+                context.insert(2, f'/{dir_r} {c.split()[1]}')
+                context.insert(3, f'/{dir_r}/lost+\\found ' + c.split()[1])
+                p2 = 1
+            if p1 == p2 == 1:
+                break
+        yield from context[:len(context) - len(triggers)]
+        yield from lines
 
     @staticmethod
     def fix_moto(input_file):
@@ -253,25 +613,36 @@ class Extractor:
                 print(f"......Wrong Size!Fixing.......\nShould:{real_size}\nYours:{orig_size}")
                 file.truncate(real_size)
 
-    def main(self, target, output_dir):
+    def main(self, target, output_dir, paths=None, metadata_only=False, image=None):
+        # paths: only extract these paths / glob patterns (relative to the image root) and their subtrees
+        # metadata_only: only write the config files (fs_config, file_contexts, ...), skip all file data
+        # image: already opened image of target (e.g. TransferListImage over a zip member), closed when done
+        self.paths = paths
+        self.image = image
+        self.metadata_only = metadata_only
         self.BASE_DIR = (os.path.realpath(os.path.dirname(target)) + os.sep)
         self.BASE_MY_DIR = output_dir + os.sep
         self.EXTRACT_DIR = os.path.realpath(os.path.dirname(output_dir)) + os.sep + self.__out_name(
             os.path.basename(output_dir), 0)  # output_dir
         self.OUTPUT_IMAGE_FILE = self.BASE_DIR + os.path.basename(target)
         self.OUTPUT_MYIMAGE_FILE = os.path.basename(target)
-        self.MYFileName = os.path.basename(self.OUTPUT_IMAGE_FILE).replace(".img", "")
-        self.FileName = self.__out_name(os.path.basename(target), 0)
+        self.MYFileName = self.__image_name(self.OUTPUT_IMAGE_FILE).replace(".img", "")
+        self.FileName = self.__out_name(self.__image_name(target), 0)
         # target_type = self.__getTypeTarget(target)
         target_type = 'img'
         self.CONFING_DIR = output_dir + os.sep + ".." + os.sep + 'config'
         if target_type == 'img':
-            with open(os.path.abspath(self.OUTPUT_IMAGE_FILE), 'rb') as f:
-                data = f.read(500000)
-            moto = re.search(b'\x4d\x4f\x54\x4f', data)
-            if moto:
-                print(".....Finding MOTO structure! Fixing.....")
-                self.fix_moto(os.path.abspath(self.OUTPUT_IMAGE_FILE))
+            # new.dat is not an image, the MOTO fix would corrupt it
+            if not target.endswith(self.NEW_DAT_SUFFIX) and image is None:
+                with open(os.path.abspath(self.OUTPUT_IMAGE_FILE), 'rb') as f:
+                    data = f.read(500000)
+                moto = re.search(b'\x4d\x4f\x54\x4f', data)
+                if moto:
+                    print(".....Finding MOTO structure! Fixing.....")
+                    self.fix_moto(os.path.abspath(self.OUTPUT_IMAGE_FILE))
             print(".....Extraction from %s to %s" % (os.path.basename(target), os.path.basename(self.EXTRACT_DIR)))
             self.__ext4extractor()
             print(".....Done! All extraction in %s" % (os.path.basename(self.EXTRACT_DIR)))
+            if self.stats:
+                print(".....Read %(bytes)d bytes of %(files)d files in %(reads)d reads, %(sequential_ratio).1f%% sequential"
+                      % dict(self.stats, sequential_ratio=self.stats['sequential_ratio'] * 100))
@@ -8,28 +8,41 @@
 
 from __future__ import print_function
 
+import bisect
 import errno
 import os
+import struct
 import sys
+import threading
+from hashlib import sha1
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
+from porttool.imagefile import ImageFile
 
-def main(TRANSFER_LIST_FILE, NEW_DATA_FILE, OUTPUT_IMAGE_FILE):
-    __version__ = '1.2'
+BLOCK_SIZE = 4096
+COPY_BUFFER_SIZE = 1024 * 1024
+COPY_JOB_SIZE = 16 * 1024 * 1024  # Longer ranges are split so the workers get even shares
 
-    print('sdat2img binary - version: {}\n'.format(__version__))
+# Android sparse image format
+SPARSE_HEADER_MAGIC = 0xED26FF3A
+CHUNK_TYPE_RAW = 0xCAC1
+CHUNK_TYPE_FILL = 0xCAC2
+CHUNK_TYPE_DONT_CARE = 0xCAC3
+
+OUTPUT_FORMATS = ('raw', 'holes', 'sparse')
 
-    def rangeset(src):
-        src_set = src.split(',')
-        num_set = [int(item) for item in src_set]
-        if len(num_set) != num_set[0] + 1:
-            print('Error on parsing following data to rangeset:\n{}'.format(src))
-            sys.exit(1)
 
-        return tuple([(num_set[i], num_set[i + 1]) for i in range(1, len(num_set), 2)])
+def rangeset(src):
+    src_set = src.split(',')
+    num_set = [int(item) for item in src_set]
+    if len(num_set) != num_set[0] + 1:
+        raise ValueError('Error on parsing following data to rangeset:\n{}'.format(src))
 
-    def parse_transfer_list_file():
-        trans_list = open(TRANSFER_LIST_FILE, 'r')
+    return tuple([(num_set[i], num_set[i + 1]) for i in range(1, len(num_set), 2)])
 
+
+def parse_transfer_list_file(TRANSFER_LIST_FILE):
+    with open(TRANSFER_LIST_FILE, 'r') as trans_list:
         # First line in transfer list is the version number
         version = int(trans_list.readline())
 
@@ -52,16 +65,436 @@ def main(TRANSFER_LIST_FILE, NEW_DATA_FILE, OUTPUT_IMAGE_FILE):
             else:
                 # Skip lines starting with numbers, they are not commands anyway
                 if not cmd[0].isdigit():
-                    print('Command "{}" is not valid.'.format(cmd))
-                    trans_list.close()
-                    sys.exit(1)
+                    raise ValueError('Command "{}" is not valid.'.format(cmd))
+
+    return version, new_blocks, commands
+
+
+def new_data_ranges(commands, block_size=BLOCK_SIZE):
+    # (first block, end block, offset in new.dat) of every new range, new.dat holds them back to back in command order
+    ranges = []
+    new_offset = 0
+    for command in commands:
+        if command[0] == 'new':
+            for begin, end in command[1]:
+                ranges.append((begin, end, new_offset))
+                new_offset += (end - begin) * block_size
+    return ranges
+
+
+def sorted_new_data_ranges(commands, block_size=BLOCK_SIZE):
+    # new_data_ranges() in block order, overlapping new ranges have no single image to read or write
+    runs = sorted(new_data_ranges(commands, block_size))
+    for previous, current in zip(runs, runs[1:]):
+        if current[0] < previous[1]:
+            raise ValueError('Overlapping new ranges at block {}'.format(current[0]))
+    return runs
+
+
+class RangeCopier(object):
+    """
+    Copies byte ranges from one unbuffered file to given offsets of another.
+
+    Uses copy_file_range (data never leaves the kernel, may even share extents) and then sendfile where the
+    platform has them, and falls back to readinto one reused buffer + pwrite when they are missing or refused.
+    """
+
+    def __init__(self, src, dst, buffer_size=COPY_BUFFER_SIZE, positional=False, skip_zeros=False,
+                 block_size=BLOCK_SIZE, stream=False):
+        # positional: only offset-based calls, several copiers can share src and dst (sendfile moves dst's position)
+        # skip_zeros: all-zero blocks are not written and stay holes in dst, the data has to pass through the buffer
+        # stream: src is a readable stream (ZipFile.open), consumed in order, source offsets are ignored
+        self.src = src
+        self.dst = dst
+        self.stream = stream
+        self.src_fd = None if stream else src.fileno()
+        self.dst_fd = dst.fileno()
+        self.use_copy_file_range = hasattr(os, 'copy_file_range') and not skip_zeros and not stream
+        self.use_sendfile = (hasattr(os, 'sendfile') and sys.platform.startswith('linux') and not positional
+                             and not skip_zeros and not stream)
+        self.skip_zeros = skip_zeros
+        self.block_size = block_size
+        self.zero_block = bytes(block_size)
+        self.buffer_size = buffer_size
+        self.data = None
+        self.buffer = None
+
+    def _copy_file_range(self, src_offset, dst_offset, length):
+        return os.copy_file_range(self.src_fd, self.dst_fd, length, src_offset, dst_offset)
+
+    def _sendfile(self, src_offset, dst_offset, length):
+        os.lseek(self.dst_fd, dst_offset, os.SEEK_SET)
+        return os.sendfile(self.dst_fd, self.src_fd, src_offset, length)
+
+    def _write(self, start, end, dst_offset):
+        written = start
+        while written < end:
+            if hasattr(os, 'pwrite'):
+                written += os.pwrite(self.dst_fd, self.buffer[written:end], dst_offset + written)
+            else:
+                self.dst.seek(dst_offset + written)
+                written += self.dst.write(self.buffer[written:end])
+
+    def _buffered(self, src_offset, dst_offset, length):
+        if self.buffer is None:
+            self.data = bytearray(self.buffer_size)
+            self.buffer = memoryview(self.data)
+        view = self.buffer[:min(length, self.buffer_size)]
+        if self.stream:
+            read = 0
+            while read < len(view):
+                count = self.src.readinto(view[read:])
+                if not count:
+                    break
+                read += count
+        elif hasattr(os, 'preadv'):
+            read = os.preadv(self.src_fd, [view], src_offset)
+        else:
+            self.src.seek(src_offset)
+            read = self.src.readinto(view)
+        if not self.skip_zeros:
+            self._write(0, read, dst_offset)
+            return read
+
+        # Only the runs of non-zero blocks, offsets are block aligned
+        start = None
+        for pos in range(0, read, self.block_size):
+            if self.data.startswith(self.zero_block, pos) and pos + self.block_size <= read:
+                if start is not None:
+                    self._write(start, pos, dst_offset)
+                    start = None
+            elif start is None:
+                start = pos
+        if start is not None:
+            self._write(start, read, dst_offset)
+        return read
+
+    def copy(self, src_offset, dst_offset, length):
+        # Returns the bytes copied, less than length only if src ends early
+        copied = 0
+        while copied < length:
+            count = length - copied
+            if self.use_copy_file_range:
+                try:
+                    done = self._copy_file_range(src_offset + copied, dst_offset + copied, count)
+                except OSError:
+                    # Old kernel, cross-filesystem copy, unsupported filesystem...
+                    self.use_copy_file_range = False
+                    continue
+            elif self.use_sendfile:
+                try:
+                    done = self._sendfile(src_offset + copied, dst_offset + copied, count)
+                except OSError:
+                    self.use_sendfile = False
+                    continue
+            else:
+                done = self._buffered(src_offset + copied, dst_offset + copied, count)
+            if not done:
+                break
+            copied += done
+        return copied
+
+
+def copy_ranges(src, dst, ranges, block_size=BLOCK_SIZE, workers=1, progress=None, skip_zeros=False, stream=False):
+    # Copies new_data_ranges() from new.dat src to image dst, workers=None uses one thread per CPU
+    # stream: src can only be read front to back, the ranges are copied one after another in new.dat order
+    jobs = []
+    for begin, end, new_offset in ranges:
+        length = (end - begin) * block_size
+        for start in range(0, length, COPY_JOB_SIZE):
+            jobs.append((new_offset + start, begin * block_size + start, min(COPY_JOB_SIZE, length - start)))
+    total_blocks = sum(end - begin for begin, end, _ in ranges)
+    copied_blocks = 0
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1 or len(jobs) <= 1 or not hasattr(os, 'pwrite') or stream:
+        copier = RangeCopier(src, dst, skip_zeros=skip_zeros, block_size=block_size, stream=stream)
+        for src_offset, dst_offset, length in jobs:
+            copier.copy(src_offset, dst_offset, length)
+            copied_blocks += length // block_size
+            if progress is not None:
+                progress(copied_blocks, total_blocks)
+        return
+
+    # Every job has its own source and target offsets, nothing is shared between threads but the two fds
+    local = threading.local()
+
+    def copy_job(src_offset, dst_offset, length):
+        if not hasattr(local, 'copier'):
+            local.copier = RangeCopier(src, dst, positional=True, skip_zeros=skip_zeros, block_size=block_size)
+        local.copier.copy(src_offset, dst_offset, length)
+        return length
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(copy_job, *job) for job in jobs]
+        for future in as_completed(futures):
+            copied_blocks += future.result() // block_size
+            if progress is not None:
+                progress(copied_blocks, total_blocks)
+
+
+def image_segments(commands, block_size=BLOCK_SIZE):
+    # Sorted (first block, end block, offset in new.dat) of the new ranges, plus (first block, end block, None) for
+    # the parts of zero ranges no new range overwrites. Everything else (erase, untouched) is left undefined.
+    runs = sorted_new_data_ranges(commands, block_size)
+    run_starts = [run[0] for run in runs]
+    zeros = []
+    for begin, end in sorted(block_set for command in commands if command[0] == 'zero' for block_set in command[1]):
+        if zeros and begin <= zeros[-1][1]:
+            zeros[-1][1] = max(zeros[-1][1], end)
+        else:
+            zeros.append([begin, end])
+
+    segments = list(runs)
+    for begin, end in zeros:
+        idx = max(bisect.bisect_right(run_starts, begin) - 1, 0)
+        while begin < end:
+            if idx < len(runs) and runs[idx][1] <= begin:
+                idx += 1
+            elif idx < len(runs) and runs[idx][0] <= begin:
+                begin = runs[idx][1]
+                idx += 1
+            else:
+                piece_end = min(end, runs[idx][0]) if idx < len(runs) else end
+                segments.append((begin, piece_end, None))
+                begin = piece_end
+    segments.sort(key=lambda segment: segment[0])
+    return segments
+
+
+class SparseImageWriter(object):
+    """
+    Writes an Android sparse image front to back.
+
+    Blocks are added in order as raw data, fill patterns or don't care; adjacent blocks of the same kind share one
+    chunk. The file header is written again with the chunk count on close().
+    """
 
-        trans_list.close()
-        return version, new_blocks, commands
+    def __init__(self, out, total_blocks, block_size=BLOCK_SIZE, raw_chunk_size=COPY_JOB_SIZE):
+        self.out = out
+        self.total_blocks = total_blocks
+        self.block_size = block_size
+        self.raw_chunk_blocks = max(raw_chunk_size // block_size, 1)
+        self.blocks = 0
+        self.chunks = 0
+        # Pending chunk: CHUNK_TYPE_*, block count, raw data parts or fill pattern
+        self.kind = None
+        self.count = 0
+        self.parts = []
+        self.pattern = None
+        self._write_header()
 
-    block_size = 4096
+    def _write_header(self):
+        self.out.write(struct.pack('<I4H4I', SPARSE_HEADER_MAGIC, 1, 0, 28, 12, self.block_size, self.total_blocks,
+                                   self.chunks, 0))
 
-    version, new_blocks, commands = parse_transfer_list_file()
+    def _flush(self):
+        if self.kind == CHUNK_TYPE_RAW:
+            self.out.write(struct.pack('<2H2I', CHUNK_TYPE_RAW, 0, self.count, 12 + self.count * self.block_size))
+            for part in self.parts:
+                self.out.write(part)
+        elif self.kind == CHUNK_TYPE_FILL:
+            self.out.write(struct.pack('<2H2I', CHUNK_TYPE_FILL, 0, self.count, 16) + self.pattern)
+        elif self.kind == CHUNK_TYPE_DONT_CARE:
+            self.out.write(struct.pack('<2H2I', CHUNK_TYPE_DONT_CARE, 0, self.count, 12))
+        else:
+            return
+        self.chunks += 1
+        self.blocks += self.count
+        self.kind = None
+        self.count = 0
+        self.parts = []
+        self.pattern = None
+
+    def add_raw(self, data):
+        # data: whole blocks
+        if self.kind != CHUNK_TYPE_RAW or self.count >= self.raw_chunk_blocks:
+            self._flush()
+            self.kind = CHUNK_TYPE_RAW
+        self.parts.append(data)
+        self.count += len(data) // self.block_size
+
+    def add_fill(self, pattern, block_count):
+        if block_count <= 0:
+            return
+        if self.kind != CHUNK_TYPE_FILL or self.pattern != pattern:
+            self._flush()
+            self.kind = CHUNK_TYPE_FILL
+            self.pattern = pattern
+        self.count += block_count
+
+    def add_dont_care(self, block_count):
+        if block_count <= 0:
+            return
+        if self.kind != CHUNK_TYPE_DONT_CARE:
+            self._flush()
+            self.kind = CHUNK_TYPE_DONT_CARE
+        self.count += block_count
+
+    def add_data(self, data):
+        # Whole blocks of image content, split into raw and fill chunks
+        block_size = self.block_size
+        fill_size = block_size // 4
+        start = 0
+        for pos in range(0, len(data), block_size):
+            pattern = data[pos:pos + 4]
+            if data[pos + 4:pos + 8] == pattern and data.startswith(pattern * fill_size, pos):
+                if start < pos:
+                    self.add_raw(data[start:pos])
+                self.add_fill(pattern, 1)
+                start = pos + block_size
+        if start < len(data):
+            self.add_raw(data[start:])
+
+    def close(self):
+        self.add_dont_care(self.total_blocks - self.blocks - self.count)
+        self._flush()
+        self.out.seek(0)
+        self._write_header()
+        self.out.seek(0, os.SEEK_END)
+
+
+def write_sparse_image(src, out, commands, total_blocks, block_size=BLOCK_SIZE, progress=None):
+    # Android sparse image of the transfer list applied to new.dat src: new data as raw / fill chunks, zero ranges
+    # as zero fill, the rest don't care. Written in block order, so always single-threaded.
+    writer = SparseImageWriter(out, total_blocks, block_size)
+    total_new_blocks = sum(end - begin for begin, end, _ in new_data_ranges(commands, block_size))
+    copied_blocks = 0
+    block = 0
+    for begin, end, new_offset in image_segments(commands, block_size):
+        writer.add_dont_care(begin - block)
+        block = end
+        if new_offset is None:
+            writer.add_fill(b'\x00' * 4, end - begin)
+            continue
+
+        length = (end - begin) * block_size
+        for start in range(0, length, COPY_BUFFER_SIZE):
+            size = min(COPY_BUFFER_SIZE, length - start)
+            if hasattr(os, 'pread'):
+                data = os.pread(src.fileno(), size, new_offset + start)
+            else:
+                src.seek(new_offset + start)
+                data = src.read(size)
+            if len(data) < size:
+                # new.dat ends early, like the raw image the rest reads as zeros
+                data += bytes(size - len(data))
+            writer.add_data(data)
+        copied_blocks += end - begin
+        if progress is not None:
+            progress(copied_blocks, total_new_blocks)
+    writer.close()
+
+
+class TransferListImage(ImageFile):
+    """
+    Read-only virtual image over NEW_DATA_FILE + TRANSFER_LIST_FILE.
+
+    The transfer list is parsed once into a sorted block -> offset in new.dat index, reads are served straight
+    from new.dat and everything else (erase / zero ranges) reads as zeros, like the image main() would write.
+    Can be mounted directly with ext4.Volume; read_at() may be called from several threads.
+    """
+
+    def __init__(self, TRANSFER_LIST_FILE, NEW_DATA_FILE, block_size=BLOCK_SIZE, new_data_offset=0):
+        # new_data_offset: where new.dat starts in NEW_DATA_FILE, e.g. a stored member of the OTA zip
+        self.version, self.new_blocks, commands = parse_transfer_list_file(TRANSFER_LIST_FILE)
+        self.block_size = block_size
+
+        runs = sorted_new_data_ranges(commands, block_size)
+        self.run_starts = [run[0] for run in runs]
+        self.runs = runs
+        self.new_data_offset = new_data_offset
+        ImageFile.__init__(self, open(NEW_DATA_FILE, 'rb'),
+                           max([end for command in commands for _, end in command[1]] or [0]) * block_size)
+
+    def read_at(self, offset, length=-1):
+        end = self.size if length < 0 else min(self.size, offset + length)
+        idx = bisect.bisect_right(self.run_starts, offset // self.block_size) - 1
+        data = []
+
+        while offset < end:
+            begin, run_end_block, new_offset = self.runs[idx] if idx >= 0 else (0, 0, 0)
+
+            if offset < run_end_block * self.block_size:
+                run_end = min(end, run_end_block * self.block_size)
+                data.append(self._pread(self.new_data_offset + new_offset + offset - begin * self.block_size,
+                                        run_end - offset))
+            else:
+                # Not written by a new command, reads as zeros up to the next range
+                idx += 1
+                run_end = min(end, self.run_starts[idx] * self.block_size) if idx < len(self.runs) else end
+                if run_end > offset:
+                    data.append(bytes(run_end - offset))
+
+            offset = run_end
+
+        return b''.join(data)
+
+
+def image_sha1(TRANSFER_LIST_FILE, NEW_DATA_FILE, ranges=None, range_hashes=False, block_size=BLOCK_SIZE):
+    # SHA-1 of the image main() would write, computed in memory over ranges ((first block, end block), ...), the whole
+    # image when None. Returns the hex digest and, with range_hashes, [(first block, end block, hex digest), ...]
+    total = sha1()
+    per_range = []
+    with TransferListImage(TRANSFER_LIST_FILE, NEW_DATA_FILE, block_size) as image:
+        if ranges is None:
+            ranges = ((0, image.size // block_size),)
+        for begin, end in ranges:
+            range_sha1 = sha1()
+            for offset in range(begin * block_size, end * block_size, COPY_BUFFER_SIZE):
+                length = min(COPY_BUFFER_SIZE, end * block_size - offset)
+                data = image.read_at(offset, length)
+                if len(data) < length:
+                    # Past the last range of the transfer list
+                    data += bytes(length - len(data))
+                total.update(data)
+                if range_hashes:
+                    range_sha1.update(data)
+            if range_hashes:
+                per_range.append((begin, end, range_sha1.hexdigest()))
+    return total.hexdigest(), per_range
+
+
+def verify(TRANSFER_LIST_FILE, NEW_DATA_FILE, expected_sha1, ranges=None):
+    # Verify mode: checks the image the transfer list builds against expected_sha1 without writing it, e.g. with
+    # SparseImage.TotalSha1() and its care_map minus clobbered_blocks as ranges
+    try:
+        actual_sha1 = image_sha1(TRANSFER_LIST_FILE, NEW_DATA_FILE, ranges)[0]
+    except (ValueError, EOFError) as e:
+        print(e)
+        return False
+    if actual_sha1 != expected_sha1:
+        print('Verify failed: SHA-1 {} expected {}'.format(actual_sha1, expected_sha1))
+        return False
+    print('Verified! SHA-1: {}'.format(actual_sha1))
+    return True
+
+
+def main(TRANSFER_LIST_FILE, NEW_DATA_FILE, OUTPUT_IMAGE_FILE, progress=None, workers=1, output_format='raw'):
+    # progress(copied blocks, total blocks) is called as ranges are copied, workers=None uses every CPU
+    # output_format: 'raw' image, 'holes' raw image with zero blocks left as holes, 'sparse' Android sparse image
+    # NEW_DATA_FILE: path, or a readable stream (ZipFile.open) that is consumed front to back
+    stream = not isinstance(NEW_DATA_FILE, (str, bytes, os.PathLike))
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError('Unknown output format {}'.format(output_format))
+    if output_format == 'sparse' and stream:
+        # Sparse images are written in block order, new.dat holds the ranges in command order
+        raise ValueError('Android sparse output needs new.dat as a file')
+    __version__ = '1.2'
+
+    print('sdat2img binary - version: {}\n'.format(__version__))
+
+    block_size = BLOCK_SIZE
+
+    try:
+        version, new_blocks, commands = parse_transfer_list_file(TRANSFER_LIST_FILE)
+        if output_format == 'sparse':
+            # Checked before the output file is created
+            sorted_new_data_ranges(commands, block_size)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
 
     if version == 1:
         print('Android Lollipop 5.0 detected!\n')
@@ -76,7 +509,8 @@ def main(TRANSFER_LIST_FILE, NEW_DATA_FILE, OUTPUT_IMAGE_FILE):
 
     # Don't clobber existing files to avoid accidental data loss
     try:
-        output_img = open(OUTPUT_IMAGE_FILE, 'wb')
+        # Sparse images are written sequentially with small chunk headers, raw images at offsets
+        output_img = open(OUTPUT_IMAGE_FILE, 'wb', buffering=-1 if output_format == 'sparse' else 0)
     except IOError as e:
         if e.errno == errno.EEXIST:
             print('Error: the output file "{}" already exists'.format(e.filename))
@@ -85,32 +519,22 @@ def main(TRANSFER_LIST_FILE, NEW_DATA_FILE, OUTPUT_IMAGE_FILE):
         else:
             raise
 
-    new_data_file = open(NEW_DATA_FILE, 'rb')
+    new_data_file = NEW_DATA_FILE if stream else open(NEW_DATA_FILE, 'rb', buffering=0)
     all_block_sets = [i for command in commands for i in command[1]]
     max_file_size = max(pair[1] for pair in all_block_sets) * block_size
 
-    for command in commands:
-        if command[0] == 'new':
-            for block in command[1]:
-                begin = block[0]
-                end = block[1]
-                block_count = end - begin
-                print('Copying {} blocks into position {}...'.format(block_count, begin))
-
-                # Position output file
-                output_img.seek(begin * block_size)
-
-                # Copy one block at a time
-                while block_count > 0:
-                    output_img.write(new_data_file.read(block_size))
-                    block_count -= 1
-        else:
-            print('Skipping command {}...'.format(command[0]))
+    if output_format == 'sparse':
+        write_sparse_image(new_data_file, output_img, commands, max_file_size // block_size, block_size, progress)
+    else:
+        # Whole ranges at a time, erase / zero ranges are left to the final truncate
+        copy_ranges(new_data_file, output_img, new_data_ranges(commands, block_size), block_size, workers, progress,
+                    skip_zeros=output_format == 'holes', stream=stream)
 
-    # Make file larger if necessary
-    if output_img.tell() < max_file_size:
-        output_img.truncate(max_file_size)
+        # Make file larger if necessary
+        if os.fstat(output_img.fileno()).st_size < max_file_size:
+            output_img.truncate(max_file_size)
 
     output_img.close()
-    new_data_file.close()
+    if not stream:
+        new_data_file.close()
     print('Done! Output image: {}'.format(os.path.realpath(output_img.name)))
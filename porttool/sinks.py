@@ -0,0 +1,188 @@
+import abc
+import io
+import os
+import stat
+import tarfile
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED
+
+from porttool import ext4
+
+# Output sinks for Extractor(sink=...): where the directories, files and symlinks of an image end up. Paths are
+# relative to the image root ("bin/sh"), modes are the permission bits as int.
+
+
+def iter_content(inode, chunk_size=ext4.BlockReader.CHUNK_SIZE):
+    reader = inode.open_read()
+    if isinstance(reader, ext4.BlockReader):
+        yield from reader.iter_chunks(chunk_size)
+    else:
+        # Inline data
+        yield reader.read()
+
+
+class Sink(abc.ABC):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        ...
+
+    @abc.abstractmethod
+    def mkdir(self, path, mode, uid, gid):
+        ...
+
+    @abc.abstractmethod
+    def write_file(self, path, inode, mode, uid, gid):
+        ...
+
+    @abc.abstractmethod
+    def symlink(self, path, target, uid, gid):
+        ...
+
+
+class FilesystemSink(Sink):
+    # Same layout as the default extraction into a directory
+    def __init__(self, root, chunk_size=ext4.BlockReader.CHUNK_SIZE):
+        self.root = root
+        self.chunk_size = chunk_size
+        os.makedirs(root, exist_ok=True)
+        self.owner = os.name == 'posix' and os.geteuid() == 0
+
+    def __target(self, path):
+        return os.path.join(self.root, path)
+
+    def __set_owner(self, target, mode, uid, gid):
+        if self.owner:
+            os.chmod(target, mode)
+            os.chown(target, uid, gid)
+
+    def mkdir(self, path, mode, uid, gid):
+        target = self.__target(path)
+        if not os.path.isdir(target):
+            os.makedirs(target)
+        self.__set_owner(target, mode, uid, gid)
+
+    def write_file(self, path, inode, mode, uid, gid):
+        target = self.__target(path)
+        with open(target, 'wb') as out:
+            inode.copy_to(out, self.chunk_size)
+        self.__set_owner(target, mode, uid, gid)
+
+    def symlink(self, path, target, uid, gid):
+        link = self.__target(path)
+        if os.path.lexists(link):
+            os.remove(link)
+        if os.name == 'nt':
+            # Same marker file the extractor writes on Windows
+            with open(link, 'wb') as out:
+                out.write(b'!<symlink>' + target.encode('utf-16') + b'\x00\x00')
+        else:
+            os.symlink(target, link)
+
+
+class ZipSink(Sink):
+    def __init__(self, file, prefix='', compression=ZIP_DEFLATED, chunk_size=ext4.BlockReader.CHUNK_SIZE):
+        # file: path or writable file object, prefix: directory inside the archive ("system")
+        self.zip = ZipFile(file, 'w', compression)
+        self.prefix = prefix.strip('/')
+        self.chunk_size = chunk_size
+
+    def __info(self, path, file_type, mode):
+        info = ZipInfo(f'{self.prefix}/{path}' if self.prefix else path)
+        info.external_attr = (file_type | mode) << 16
+        info.compress_type = self.zip.compression
+        return info
+
+    def close(self):
+        self.zip.close()
+
+    def mkdir(self, path, mode, uid, gid):
+        info = self.__info(path + '/', stat.S_IFDIR, mode)
+        info.external_attr |= 0x10  # MS-DOS directory flag
+        self.zip.writestr(info, b'')
+
+    def write_file(self, path, inode, mode, uid, gid):
+        info = self.__info(path, stat.S_IFREG, mode)
+        # Known size up front, zipfile switches to zip64 on its own
+        info.file_size = inode.size
+        with self.zip.open(info, 'w') as out:
+            for chunk in iter_content(inode, self.chunk_size):
+                out.write(chunk)
+
+    def symlink(self, path, target, uid, gid):
+        self.zip.writestr(self.__info(path, stat.S_IFLNK, 0o777), target)
+
+
+class TarSink(Sink):
+    def __init__(self, file, prefix='', mode='w'):
+        # file: path or writable file object, mode: tarfile mode ('w', 'w:gz', 'w|xz', ...)
+        if isinstance(file, (str, os.PathLike)):
+            self.tar = tarfile.open(file, mode)
+        else:
+            self.tar = tarfile.open(fileobj=file, mode=mode)
+        self.prefix = prefix.strip('/')
+
+    def __info(self, path, file_type, mode, uid, gid):
+        info = tarfile.TarInfo(f'{self.prefix}/{path}' if self.prefix else path)
+        info.type = file_type
+        info.mode = mode
+        info.uid = uid
+        info.gid = gid
+        return info
+
+    def close(self):
+        self.tar.close()
+
+    def mkdir(self, path, mode, uid, gid):
+        self.tar.addfile(self.__info(path, tarfile.DIRTYPE, mode, uid, gid))
+
+    def write_file(self, path, inode, mode, uid, gid):
+        info = self.__info(path, tarfile.REGTYPE, mode, uid, gid)
+        info.size = inode.size
+        # BlockReader streams the content, tarfile reads it in its own buffer size
+        self.tar.addfile(info, inode.open_read())
+
+    def symlink(self, path, target, uid, gid):
+        info = self.__info(path, tarfile.SYMTYPE, 0o777, uid, gid)
+        info.linkname = target
+        self.tar.addfile(info)
+
+
+class MemorySink(Sink):
+    def __init__(self):
+        self.dirs = {}  # path -> (mode, uid, gid)
+        self.files = {}  # path -> (content, mode, uid, gid)
+        self.symlinks = {}  # path -> target
+
+    def mkdir(self, path, mode, uid, gid):
+        self.dirs[path] = (mode, uid, gid)
+
+    def write_file(self, path, inode, mode, uid, gid):
+        content = io.BytesIO()
+        for chunk in iter_content(inode):
+            content.write(chunk)
+        self.files[path] = (content.getvalue(), mode, uid, gid)
+
+    def symlink(self, path, target, uid, gid):
+        self.symlinks[path] = target
+
+
+class NullSink(Sink):
+    # Reads and drops everything, measures decode throughput without any write cost
+    def __init__(self, chunk_size=ext4.BlockReader.CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.dirs = self.files = self.symlinks = self.bytes = 0
+
+    def mkdir(self, path, mode, uid, gid):
+        self.dirs += 1
+
+    def write_file(self, path, inode, mode, uid, gid):
+        self.files += 1
+        for chunk in iter_content(inode, self.chunk_size):
+            self.bytes += len(chunk)
+
+    def symlink(self, path, target, uid, gid):
+        self.symlinks += 1
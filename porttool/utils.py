@@ -1,13 +1,14 @@
 import glob
 import os.path as op
 import re
+import struct
 import subprocess
 
 from hashlib import md5
 from os import walk, getcwd, chdir, symlink, readlink, name as osname, stat, unlink
 from pathlib import Path
 from shutil import rmtree, copytree
-from zipfile import ZipFile, ZIP_DEFLATED, is_zipfile
+from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED, is_zipfile
 from .Magisk import Magisk_patch
 from .bootimg import unpack_bootimg, repack_bootimg
 from .configs import (
@@ -16,8 +17,9 @@ from .configs import (
     img2simg_bin
 )
 from .img2sdat import main as img2sdat
+from .img2sdat.sparse_img import SparseImage
 from .imgextractor import Extractor
-from .sdat2img import main as sdat2img
+from .sdat2img import main as sdat2img, TransferListImage, verify as sdat_verify
 
 if osname == 'nt':
     from ctypes import windll, wintypes
@@ -150,6 +152,28 @@ def compress_zip(zippath: str, indir: str):
                 zipf.write(file_path, op.relpath(op.abspath(file_path), op.abspath(indir)))
 
 
+def image_size(path: str) -> int:
+    # 分区大小: sparse镜像的文件大小只是压缩后的大小, 要用展开后的 blocksize * total_blocks
+    with open(path, 'rb') as f:
+        magic = f.read(4)
+    if magic != Extractor.SPARSE_MAGIC:
+        return stat(path).st_size
+    simg = SparseImage(path, build_map=False)
+    simg.simg_f.close()
+    return simg.blocksize * simg.total_blocks
+
+
+def zip_member_offset(zippath: str, info) -> int:
+    # 成员数据在zip中的起始偏移, 本地文件头的extra字段可能和中央目录里的不同
+    with open(zippath, 'rb') as f:
+        f.seek(info.header_offset)
+        header = f.read(30)
+    if header[:4] != b'PK\x03\x04':
+        raise ValueError(f"Bad local file header for {info.filename}")
+    name_len, extra_len = struct.unpack('<2H', header[26:30])
+    return info.header_offset + 30 + name_len + extra_len
+
+
 class bootutil:
     def __init__(self, bootpath):
         self.bootpath = op.abspath(bootpath)
@@ -238,7 +262,9 @@ class portutils:
         if not is_zipfile(self.portzip):
             print("文件不是ZIP, 请重新选择移植包")
             return
-        ZipFile(self.portzip, 'r').extractall(outdir)
+        with ZipFile(self.portzip, 'r') as z:
+            # system.new.dat 不解压, __port_system 直接从zip中读取
+            z.extractall(outdir, [name for name in z.namelist() if name != "system.new.dat"])
 
     def __port_boot(self) -> bool:
         def __replace(src: Path, dest: Path):
@@ -360,28 +386,28 @@ class portutils:
                 port_prefix.joinpath(val).write_bytes(
                     base_prefix.joinpath(val).read_bytes()
                 )
+        base_paths = self.__base_paths()
         print("检测system md5检验和是否相同")
         with open(self.sysimg, 'rb') as f:
             md5filter = md5()
             for chunk in iter(lambda: f.read(4096), b""):
                 md5filter.update(chunk)
+            md5filter.update(' '.join(base_paths).encode())  # 只解包需要的文件, 解包范围也计入校验
             sysmd5 = md5filter.hexdigest()
         md5path = Path("base/system.md5")
         if not md5path.exists():
-            md5path.parent.mkdir(parents=True, exist_ok=True)
-            md5fd = md5path.open("w")
-            md5fd.write(sysmd5)
             readmd5 = ''
         else:
-            md5fd = md5path.open("r+")
-            readmd5 = md5fd.readline().rstrip()
-        md5fd.close()
+            with md5path.open("r") as md5fd:
+                readmd5 = md5fd.readline().rstrip()
         if sysmd5 == readmd5 and Path("base/system").exists():
             unpack_flag = False
             print("检测到system已经解包，无需二次解包以减少移植时间")
         else:
             unpack_flag = True
-            md5path.parent.mkdir(parents=True, exist_ok=True)
+            # 解包完成后才写入md5, 中断的解包不会被当作缓存
+            if md5path.exists():
+                md5path.unlink()
             syspath = Path("base/system")
             configpath = Path("base/config")
             if syspath.exists():
@@ -390,17 +416,23 @@ class portutils:
                 rmtree("base/config")
         if unpack_flag:
             print("开始解包system镜像... ", end='')
-            Extractor().main(self.sysimg, "base/system")
+            # base/system 只读不改, 可以安全使用硬链接
+            # 不使用索引: 只解包 base_paths, 建索引要遍历整个镜像
+            Extractor(workers=None, physical_order=True, hardlinks=True, dedupe='hardlink').main(
+                self.sysimg, "base/system", base_paths)
+            md5path.parent.mkdir(parents=True, exist_ok=True)
+            md5path.write_text(sysmd5)
             print("解包完成")
 
-        if Path("tmp/rom/system.new.dat").exists():
+        with ZipFile(self.portzip, 'r') as z:
+            new_dat = z.getinfo("system.new.dat") if "system.new.dat" in z.namelist() else None
+        if new_dat is not None:
             print("检测到system.new.dat格式镜像，需要转换")
             self.sdat = True
             with open("tmp/rom/system.transfer.list") as t:
                 self.sdat_ver = int(t.readline().rstrip("\n"))
-            sdat2img("tmp/rom/system.transfer.list", "tmp/rom/system.new.dat", "tmp/rom/system.img")
             print("解包目标system镜像中...")
-            Extractor().main("tmp/rom/system.img", "tmp/rom/system")
+            self.__extract_new_dat(new_dat)
 
         base_prefix = Path("base/system")
         port_prefix = Path("tmp/rom/system")
@@ -412,6 +444,7 @@ class portutils:
                 continue
             if item.startswith("replace_"):
                 for i in self.items['replace'][item.split('_')[1]]:
+                    i = i.strip()  # 配置里有些条目带尾随空格
                     if base_prefix.joinpath(i).exists() or ("*" in i):
                         __replace(i)
                     else:
@@ -465,6 +498,37 @@ class portutils:
                             pp.setprop(key, value)
         return True
 
+    def __extract_new_dat(self, info):
+        # system.new.dat 不从移植包中解压出来
+        transfer_list = "tmp/rom/system.transfer.list"
+        # 只有文件系统支持reflink(btrfs, xfs...)时去重才有意义
+        # 否则每个重复文件都要多读一遍再完整复制
+        dedupe = 'reflink' if Extractor.reflink_supported("tmp/rom") else None
+        if info.compress_type == ZIP_STORED and not info.flag_bits & 0x1:
+            # 未压缩: new.dat 就是zip中的一段数据, 配合transfer.list直接读取
+            image = TransferListImage(transfer_list, self.portzip,
+                                      new_data_offset=zip_member_offset(self.portzip, info))
+            Extractor(workers=None, physical_order=True, dedupe=dedupe).main(
+                "tmp/rom/system.new.dat", "tmp/rom/system", image=image)
+            return
+        # 压缩: 边解压边写入稀疏的 system.img, transfer.list 按顺序读取 new.dat
+        with ZipFile(self.portzip, 'r') as z, z.open(info) as new_data:
+            sdat2img(transfer_list, new_data, "tmp/rom/system.img", output_format='holes')
+        Extractor(workers=None, physical_order=True, dedupe=dedupe).main(
+            "tmp/rom/system.img", "tmp/rom/system")
+        unlink("tmp/rom/system.img")
+
+    def __base_paths(self) -> list:
+        # 底包中移植需要用到的文件: build.prop 和 replace_* 条目
+        paths = ['build.prop']
+        for item in self.items['flags']:
+            if item in ('replace_kernel', 'replace_fstab') or not item.startswith("replace_"):
+                continue
+            if self.items[item]:
+                # 配置里有些条目带尾随空格, 原样匹配不到文件
+                paths.extend(i.strip() for i in self.items['replace'][item.split('_')[1]])
+        return paths
+
     def __pack_rom(self):
         for item in self.items['flags']:
             item_flag = self.items['flags'][item]
@@ -559,7 +623,7 @@ class portutils:
             fs_config.close()
 
             fit_size = self.__pack_fit_size()
-            sys_size = stat(self.sysimg).st_size
+            sys_size = image_size(self.sysimg)
 
             make_ext4fs_cmd = [
                 make_ext4fs_bin,
@@ -585,6 +649,9 @@ class portutils:
                 unlink("tmp/rom/system.transfer.list")
 
             img2sdat("out/system.img", "tmp/rom", self.sdat_ver)
+            if not self.__verify_sdat():
+                print("Error: system.new.dat 与 out/system.img 不一致, 停止打包")
+                return False
             if op.isfile("tmp/rom/system.img"):
                 print("删除遗留system镜像...")
                 unlink("tmp/rom/system.img")
@@ -592,6 +659,17 @@ class portutils:
         print("完成！")
         return
 
+    @staticmethod
+    def __verify_sdat() -> bool:
+        print("校验system.new.dat...")
+        # clobbered block 与 img2sdat 相同, TotalSha1 不计入该块
+        simg = SparseImage("out/system.img", clobbered_blocks='0')
+        try:
+            return sdat_verify("tmp/rom/system.transfer.list", "tmp/rom/system.new.dat", simg.TotalSha1(),
+                               simg.care_map.subtract(simg.clobbered_blocks))
+        finally:
+            simg.simg_f.close()
+
     @staticmethod
     def __pack_fit_size():
         total = 0
@@ -733,7 +811,7 @@ class portutils:
         file_contexts.close()
 
         fit_size = self.__pack_fit_size()
-        sys_size = stat(self.sysimg).st_size
+        sys_size = image_size(self.sysimg)
         make_ext4fs_cmd = [
             make_ext4fs_bin,
             # '-s', # sparse image